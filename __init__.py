@@ -5,4 +5,5 @@ import norm
 import hrf
 import misc
 import io
-import stats
\ No newline at end of file
+import stats
+import glm
\ No newline at end of file
@@ -86,7 +86,7 @@ df = pd.DataFrame(data=data, columns=(
 
 if args.convolve:
     tocon = ['box', 'acc', 'p']
-    condf = convolve_hrf(df, dg(), tocon)
+    condf = convolve_hrf(df, dg(), tocon, groups="count")
     for con in tocon:
         df[con] = condf[con]
 
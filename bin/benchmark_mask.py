@@ -0,0 +1,78 @@
+"""Benchmark roi.pre.mask against the exhaustive neighborhood search 
+it replaced."""
+import time
+import argparse
+import numpy as np
+import nibabel as nb
+from modelmodel.roi.pre import mask
+from modelmodel.roi.pre import _affine_index
+from modelmodel.roi.pre import _affine_xyz
+from modelmodel.roi.pre import _search_neighborhood
+
+
+parser = argparse.ArgumentParser(
+        description="Time ROI masking, checking the masks agree",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+        )
+parser.add_argument(
+        "nifti", type=str,
+        help="Name of the BOLD nifti1 file"
+        )
+parser.add_argument(
+        "roi", type=str,
+        help="Name of the (binary) ROI nifti1 file"
+        )
+parser.add_argument(
+        "--standard", type=bool, default=True,
+        help="Use the q_form (True) or s_form (False) affine"
+        )
+args = parser.parse_args()
+
+nifti = nb.load(args.nifti)
+roi = nb.load(args.roi)
+
+start = time.time()
+masked = mask(nifti, roi, standard=args.standard)
+vol = masked.get_data()
+if vol.ndim > 3:
+    vol = vol[...,0]
+mask_time = time.time() - start
+
+# The original (exhaustive) search
+start = time.time()
+if args.standard:
+    roi_affine = roi.get_header().get_qform()
+    nifti_affine = nifti.get_header().get_qform()
+else:
+    roi_affine = roi.get_header().get_sform()
+    nifti_affine = nifti.get_header().get_sform()
+
+roi_index = np.argwhere(roi.get_data().astype('int8') == 1)
+roi_std_index = np.array([_affine_xyz(xyz, roi_affine) for xyz in roi_index])
+nifti_std_index = _affine_index(np.zeros(nifti.shape[0:3]), nifti_affine)
+
+neighborhood = np.abs(np.diag(nifti_affine)[0:3]) - np.abs(np.diag(roi_affine)[0:3])
+neighborhood[neighborhood < 1] = 1.0
+
+matches = []
+[matches.extend(_search_neighborhood(
+        nifti_std_index, xyz, neighborhood)) for xyz in roi_std_index]
+
+inv_nifti_affine = np.linalg.inv(nifti_affine)
+search_mask = np.zeros(nifti.shape[0:3], dtype=np.bool)
+for x, y, z in [_affine_xyz(xyz, inv_nifti_affine) for xyz in matches]:
+    search_mask[x, y, z] = True
+search_time = time.time() - start
+
+# Inside the search mask the data should be unchanged,
+# outside it should all be zero.
+data = nifti.get_data()
+if data.ndim > 3:
+    data = data[...,0]
+agree = np.all(vol[~search_mask] == 0) and np.array_equal(
+        vol[search_mask], data[search_mask].astype(vol.dtype))
+
+print("mask: {0:.3f}s".format(mask_time))
+print("search: {0:.3f}s".format(search_time))
+print("Speedup: {0:.1f}x".format(search_time / mask_time))
+print("Masks agree: {0}".format(agree))
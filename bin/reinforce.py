@@ -78,7 +78,7 @@ df = pd.concat(dfs, axis=0)
 
 if args.convolve:
     tocon = ['box', 'acc', 'p', 'rpe', 'value']
-    condf = convolve_hrf(df, dg(), tocon)
+    condf = convolve_hrf(df, dg(), tocon, groups="count")
     for con in tocon:
         df[con] = condf[con]
 
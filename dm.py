@@ -3,18 +3,24 @@ import numpy as np
 import pandas as pd
 
 from copy import deepcopy
-from statsmodels.api import GLS
+from modelmodel.hrf import kernel_fft
 
 
-def convolve_hrf(dm, hrf, cols=None):
+def convolve_hrf(dm, hrf, cols=None, groups=None):
     """Convolve hrf onto design matrix columns.
     
     dm : array-like or DataFrame (n_samples, n_conds)
-        The design matrix
+        The design matrix. Arrays can also be 1d (n_samples, ), or
+        a stack of design matrices (n_dm, n_samples, n_conds).
     hrf : array-like
         The HRF to convolve the dm cols with
     cols : list, array-like, None
         Only convolve select cols. 
+    groups : array-like, str, None
+        Group (e.g. run or iteration) labels for each sample; 
+        each group is convolved separately so the HRF does not 
+        bleed from one into the next. For DataFrames this can 
+        be a col name. Not for stacks of design matrices.
     
     Note
     ----
@@ -22,40 +28,138 @@ def convolve_hrf(dm, hrf, cols=None):
     are returned. The cols can be a seqeunce of ints
     if dm if array-like or a DataFrame, or a seqeunce
     of strs if DataFrame only.
+
+    DataFrames are the exception; a copy of the whole 
+    DataFrame is returned, with cols convolved.
+
+    All selected cols (of all design matrices) are convolved 
+    in one go, directly or by FFT, whichever is faster for 
+    the length of dm and hrf.
     """
 
-    if dm.ndim != 2:
-        raise ValueError("dm must be 2d")
+    hrf = np.asarray(hrf, dtype=float)
+
+    if isinstance(dm, pd.DataFrame):
+        if isinstance(groups, str):
+            groups = dm[groups].values
+
+        if cols is None:
+            cols = list(dm.columns)
+        cols = [dm.columns[col] if col not in dm.columns else col 
+                for col in cols]
+            ## ints are positions
+        
+        dm_c = dm.copy()
+        convolved = _convolve(dm[cols].values.astype(float), hrf, groups)
+        for j, col in enumerate(cols):
+            dm_c[col] = convolved[:,j]
+        
+        return dm_c
+
+    dm = np.asarray(dm, dtype=float)
+    if dm.ndim == 1:
+        return _convolve(dm, hrf, groups)
+    elif dm.ndim == 2:
+        if cols is not None:
+            dm = dm[:,cols]
+        
+        return _convolve(dm, hrf, groups)
+    elif dm.ndim == 3:
+        if groups is not None:
+            raise ValueError("groups can't be used with a stack of dms")
+        if cols is not None:
+            dm = dm[:,:,cols]
+
+        # Put time first
+        return _convolve(dm.transpose(1, 0, 2), hrf).transpose(1, 0, 2)
+    else:
+        raise ValueError("dm must be 1, 2 or 3d")
+
+
+def _convolve(data, hrf, groups=None):
+    """Convolve every column of <data> (time is the first axis) with 
+    <hrf>, keeping only the first n_samples of the result.
+    
+    If <groups> is not None, each group is convolved separately."""
+
+    if groups is not None:
+        return _convolve_groups(data, hrf, groups)
+
+    n_sample = data.shape[0]
+    n_fft = 2 ** int(np.ceil(np.log2(n_sample + hrf.shape[0] - 1)))
+
+    # Direct convolution takes a pass over data for each 
+    # hrf entry, FFTs take roughly log2(n_fft) passes. 
+    if hrf.shape[0] > 3 * np.log2(n_fft):
+        freq = kernel_fft(hrf, n_fft).reshape((-1, ) + (1, ) * (
+                data.ndim - 1))
+        convolved = np.fft.irfft(
+                np.fft.rfft(data, n_fft, axis=0) * freq, n_fft, axis=0)
+        
+        return convolved[0:n_sample]
+
+    convolved = np.zeros(data.shape)
+    for lag, weight in enumerate(hrf[0:n_sample]):
+        convolved[lag:] += weight * data[0:n_sample-lag]
+
+    return convolved
+
+
+def _convolve_groups(data, hrf, groups):
+    """Convolve each group of rows in <data> separately (see 
+    _convolve()), in one go.
+    
+    The groups are scattered into a (n_groups, max_group_size, ...)
+    zero-padded array, that is convolved along its second (time) 
+    axis, and the results gathered back into place. """
+
+    groups = np.asarray(groups)
+    if groups.shape[0] != data.shape[0]:
+        raise ValueError("groups and dm have different n_samples")
     
-    if cols is None:
-            cols = range(dm.shape[1]) # 2d?    
+    # Find each row's group and 
+    # its position in that group.
+    codes = np.unique(groups, return_inverse=True)[1]
+    order = np.argsort(codes, kind='mergesort')
+        ## Stable, so rows stay 
+        ## in time order
+    counts = np.bincount(codes)
+    starts = np.cumsum(counts) - counts
+    sorted_codes = codes[order]
+    positions = np.arange(order.shape[0]) - starts[sorted_codes]
 
-    dm_c = dm.copy()
-    for j, col in enumerate(cols):
-        try:
-            # is pd and cols are ints?
-            dm_c.ix[col] = np.convolve(dm.ix[col], hrf)[0:dm.shape[0]]
-        except (AttributeError, KeyError):
-            try:
-                # is np?
-                dm_c[:,j] = np.convolve(dm[:,col], hrf)[0:dm.shape[0]] 
-            except TypeError:
-                # is pd and col are strings
-                dm_c[col] = np.convolve(dm[col], hrf)[0:dm.shape[0]] 
+    padded = np.zeros((counts.shape[0], counts.max()) + data.shape[1:])
+    padded[sorted_codes, positions] = data[order]
     
-    return dm_c
+    padded = np.swapaxes(_convolve(np.swapaxes(padded, 0, 1), hrf), 0, 1)
 
+    convolved = np.zeros(data.shape)
+    convolved[order] = padded[sorted_codes, positions]
 
-def orthogonalize(dm, cols):
+    return convolved
+
+
+def orthogonalize(dm, cols, chain=False):
     """ Orthogonalize dm cols (by regression). 
     
     Parameters
     ---------
-    dm : array-like (n_samples, n_cond)
-        The design matrix
+    dm : array-like or DataFrame (n_samples, n_cond)
+        The design matrix. Arrays can also be a stack of design 
+        matrices (n_dm, n_samples, n_cond).
     cols : list
         A list of cols to orthogonalize pair-wise
-        moving rightward
+        moving rightward, or a list of [left, right] 
+        pairs
+    chain : bool
+        If True, each col is orthogonalized to all the (already 
+        orthogonalized) cols to its left (i.e. Gram-Schmidt), 
+        rather than only the (original) col just to its left.
+    
+    Note
+    ----
+    The residuals from regressing right on left (with no intercept)
+    are found by projection, for all pairs (and dms) at once.
     """
     
     if dm.ndim == 1:
@@ -63,23 +167,77 @@ def orthogonalize(dm, cols):
     if len(cols) < 2:
         raise ValueError("cols must have two elements")
     
-    orth_dm = dm.copy()
-    for j in range(len(cols)-1):
-        left = cols[j]
-        right = cols[j+1]
-        
-        # Orthgonalize left to right....
-        ## GLS(y
-        try:
-            glm = GLS(dm[:,right], dm[:,left]).fit()    ## np
-            orth_dm[:,right] = glm.resid
-        except TypeError:
-            glm = GLS(dm[right], dm[left]).fit()        ## pd
-            orth_dm[right] = glm.resid
+    if isinstance(cols[0], (list, tuple)):
+        if chain:
+            raise ValueError("chain can't be used with pairs")
+        lefts = [left for left, _ in cols]
+        rights = [right for _, right in cols]
+    else:
+        lefts = list(cols[:-1])
+        rights = list(cols[1:])
+
+    if isinstance(dm, pd.DataFrame):
+        orth_dm = dm.copy()
+        if chain:
+            orth_dm[list(cols)] = _gram_schmidt(dm[list(cols)].values)
+        else:
+            orth_dm[rights] = _project_out(dm[lefts].values, dm[rights].values)
         
+        return orth_dm
+    
+    dm = np.asarray(dm, dtype=float)
+    orth_dm = dm.copy()
+    if chain:
+        orth_dm[...,cols] = _gram_schmidt(dm[...,cols])
+    else:
+        orth_dm[...,rights] = _project_out(dm[...,lefts], dm[...,rights])
+    
     return orth_dm
 
 
+def _project_out(left, right):
+    """Residuals of each right col after regressing 
+    it (with no intercept) on the matching left col."""
+
+    left = np.asarray(left, dtype=float)
+    right = np.asarray(right, dtype=float)
+
+    norm = (left ** 2).sum(axis=-2)
+    beta = (left * right).sum(axis=-2) / np.where(norm == 0, 1, norm)
+        ## A zero left col explains nothing
+
+    return right - left * beta[...,np.newaxis,:]
+
+
+def _gram_schmidt(data):
+    """Orthogonalize each col of data (n_samples, n_cond), or a stack 
+    of them, to all the cols to its left, keeping scale. 
+    
+    The loop is over cols only; each step is done for every dm in 
+    the stack at once. """
+
+    data = np.asarray(data, dtype=float)
+    orth = data.copy()
+    for j in range(1, data.shape[-1]):
+        left = orth[...,0:j]
+        norm = (left ** 2).sum(axis=-2)
+        beta = (left * data[...,j:j+1]).sum(axis=-2) / np.where(
+                norm == 0, 1, norm)
+            ## A zero left col explains nothing
+        orth[...,j] = data[...,j] - (left * beta[...,np.newaxis,:]).sum(
+                axis=-1)
+        
+        # Round off what is left of a col that its 
+        # left cols fully explain, so it explains 
+        # nothing in turn.
+        tiny = (orth[...,j] ** 2).sum(axis=-1) <= (
+                (data[...,j] ** 2).sum(axis=-1) * 
+                data.shape[-2] * np.finfo(float).eps)
+        orth[...,j][tiny] = 0
+
+    return orth
+
+
 def add_movement(dm, movement):
     """Add a movement matrix to the design matrix
     
@@ -3,7 +3,6 @@ import shutil
 import argparse
 import numpy as np
 import pandas as pd
-import statsmodels.formula.api as smf
 
 from patsy.builtins import scale
 
@@ -13,6 +12,10 @@ from modelmodel.noise import white
 from modelmodel.hrf import double_gamma as dg
 from modelmodel.dm import convolve_hrf
 from modelmodel.dm import orthogonalize
+from modelmodel.glm import ols_model
+from modelmodel.glm import column
+from modelmodel.glm import t_test
+from modelmodel.glm import f_test
 from modelmodel.io import reformat_model
 from modelmodel.io import read_models
 from modelmodel.io import reformat_contrast
@@ -52,6 +55,10 @@ parser.add_argument(
         "--save_behave", type=bool, default=False,
         help="Save the behave data?"
         )
+parser.add_argument(
+        "--save_resid", type=bool, default=False,
+        help="Save the model residuals?"
+        )
 parser.add_argument(
         "--seed",
         default=42, type=int,
@@ -68,6 +75,7 @@ model_configs = read_models(args.models)
 asbold = ['box', 'acc', 'p', 'value', 'rpe', 'rand']
 
 # Regress for each BOLD, and model for N interations 
+hrf = dg()
 results = {}
 for n in range(args.N):
     print("Iteration {0}".format(n))
@@ -87,40 +95,49 @@ for n in range(args.N):
     df, rlpars = reinforce.rescorla_wagner(trials, acc, p, prng=prng)
 
     # Convolve with HRF
-    df = convolve_hrf(df, dg(), asbold)
+    df = convolve_hrf(df, hrf, asbold)
     
     # Orth select regressors
     to_orth = [['box', bold] for bold in asbold if bold != 'box']
-    for orth in to_orth:
-        df[orth[1]+'_o'] = orthogonalize(df, orth)[orth[1]]
+    orth_df = orthogonalize(df, to_orth)
+    for left, right in to_orth:
+        df[right+'_o'] = orth_df[right]
     
-    # Do the regressions    
+    # Do the regressions, simulating a BOLD col 
+    # for each of asbold and fitting them in one go
     n_results = {}
     for model_name, model, test, hypoth in zip(*model_configs):
+        l = df.shape[0]
+        bolds = []
         for bold_name in asbold:
-            l = df.shape[0]
             noi, prng = white(l, prng=prng)
+            bolds.append(create_bold([df[bold_name].values], None, noi))
+        bolds = np.vstack(bolds).transpose()
+
+        glmo = ols_model(model, df, bolds, resid=args.save_resid)
+
+        stato = None
+        if test == 't':
+            stato = t_test(glmo, hypoth)
+        elif test == 'F':
+            stato = f_test(glmo, hypoth)
+        elif test is not None:
+            raise ValueError("Unknown test")
 
-            df['bold'] = create_bold([df[bold_name].values], None, noi)
+        for k, bold_name in enumerate(asbold):
+            print("{0} {1}: r = {2:.3f}".format(
+                    model_name, bold_name, glmo['r'][k]))
 
-            smo = smf.ols(model, data=df).fit()
-            print(smo.summary2())
-            
-            stato = None
-            if test == 't':
-                stato = smo.t_test(hypoth)
-            elif test == 'F':
-                stato = smo.f_test(hypoth)
-            elif test is not None:
-                raise ValueError("Unknown test")
-            
             savedf = None
             if args.save_behave: 
+                df['bold'] = bolds[:,k]
                 savedf = df 
 
             n_results.update(merge_results(
                     'bold:'+bold_name + '_' + 'model:'+model_name,
-                    model, smo, df=savedf, stato=stato, other=rlpars
+                    model, column(glmo, k), df=savedf, 
+                    stato=None if stato is None else column(stato, k), 
+                    other=rlpars, resid=args.save_resid
                     ))
                     
     results.update({str(n) : n_results})
@@ -0,0 +1,487 @@
+"""Batched (mass-univariate) ordinary least squares.
+
+The design matrix is factored (SVD) once and every BOLD column is
+solved for in one matrix multiply, rather than with a statsmodels
+object per column.  Results are dicts of arrays, named as in
+io.reformat_model(). """
+import ast
+import hashlib
+import numpy as np
+import scipy.stats as stats
+
+from patsy import DesignInfo
+from patsy import ModelDesc
+from patsy import EvalEnvironment
+from patsy import dmatrix
+from patsy import build_design_matrices
+from modelmodel.misc import LRUCache
+
+
+_FORMULAS = LRUCache(maxsize=128)
+_DESIGNS = LRUCache(maxsize=128)
+_BOLDS = LRUCache(maxsize=128)
+
+_SHARED = ("df_model", "df_resid", "df_num", "df_denom", "nobs", "names")
+
+
+def ols(X, Y, names=None, resid=False, const=None):
+    """Fit Y ~ X with ordinary least squares.
+
+    Parameters
+    ----------
+    X : array-like (n_samples, n_features)
+        The design matrix
+    Y : array-like (n_samples, ) or (n_samples, n_bold)
+        The BOLD data, one col per fit
+    names : list, None
+        Names for the X cols (needed for t_test() and f_test())
+    resid : bool
+        Also return the residuals?
+    const : array-like (n_samples, ), None
+        The model's constant col (e.g. whitened, see ar1()). If 
+        None, it is looked for in X.
+
+    Return
+    ------
+    results : dict
+        beta, t, p, ci, fvalue, f_pvalue, r, r_adj, aic, bic, llf,
+        mse_model, mse_resid and mse_total, with a trailing n_bold
+        axis if Y was 2d. Also the shared df_model, df_resid, nobs,
+        normalized_cov and names.
+
+    Note
+    ----
+    As in statsmodels, the model is taken to have a constant if any
+    col of X is constant, and rank deficient X are solved with the
+    pseudoinverse.
+    """
+
+    X = np.asarray(X, dtype=float)
+    Y = np.asarray(Y, dtype=float)
+    if X.ndim != 2:
+        raise ValueError("X must be 2d")
+    if X.shape[0] != Y.shape[0]:
+        raise ValueError("X and Y have different n_samples")
+
+    n = X.shape[0]
+
+    # Factor X once.
+    u, s, vt = np.linalg.svd(X, full_matrices=False)
+    keep = s > (s.max() * max(X.shape) * np.finfo(float).eps)
+    u, s, vt = u[:,keep], s[keep], vt[keep]
+    pinv = (vt.T / s).dot(u.T)
+    normalized_cov = (vt.T / s ** 2).dot(vt)
+    rank = s.shape[0]
+
+    if const is None:
+        k_constant = int(np.any(
+                (np.ptp(X, axis=0) == 0) & np.any(X != 0, axis=0)))
+        if k_constant:
+            const = np.ones(n)
+    else:
+        const = np.asarray(const, dtype=float)
+        k_constant = 1
+    df_model = rank - k_constant
+    df_resid = n - rank
+
+    # Then solve all the cols in one go.
+    beta = pinv.dot(Y)
+    residuals = Y - X.dot(beta)
+    ssr = (residuals ** 2).sum(axis=0)
+    if k_constant:
+        mean = np.outer(const, const.dot(Y) / const.dot(const))
+        tss = ((Y - mean.reshape(Y.shape)) ** 2).sum(axis=0)
+    else:
+        tss = (Y ** 2).sum(axis=0)
+
+    mse_model = (tss - ssr) / df_model
+    mse_resid = ssr / df_resid
+    mse_total = tss / (df_resid + df_model)
+    fvalue = mse_model / mse_resid
+
+    r = 1 - ssr / tss
+    r_adj = 1 - (n - k_constant) / float(df_resid) * (1 - r)
+
+    llf = -n / 2. * (np.log(2 * np.pi) + np.log(ssr / n) + 1)
+    k = df_model + k_constant
+
+    bse = np.sqrt(np.multiply.outer(np.diag(normalized_cov), mse_resid))
+    t = beta / bse
+    q = stats.t.ppf(0.975, df_resid)
+    ci = np.concatenate([
+            (beta - q * bse)[:,np.newaxis], (beta + q * bse)[:,np.newaxis]],
+            axis=1)
+
+    results = {
+        "beta" : beta,
+        "t" : t,
+        "p" : 2 * stats.t.sf(np.abs(t), df_resid),
+        "ci" : ci,
+        "fvalue" : fvalue,
+        "f_pvalue" : stats.f.sf(fvalue, df_model, df_resid),
+        "r" : r,
+        "r_adj" : r_adj,
+        "aic" : -2 * llf + 2 * k,
+        "bic" : -2 * llf + np.log(n) * k,
+        "llf" : llf,
+        "mse_model" : mse_model,
+        "mse_resid" : mse_resid,
+        "mse_total" : mse_total,
+        "df_model" : df_model,
+        "df_resid" : df_resid,
+        "nobs" : n,
+        "normalized_cov" : normalized_cov,
+        "names" : names
+    }
+    if resid:
+        results["resid"] = residuals
+
+    return results
+
+
+def ar1(X, Y, names=None, bins=None, resid=False):
+    """Fit Y ~ X with AR(1) prewhitened least squares (i.e. GLS).
+
+    Parameters
+    ----------
+    X : array-like (n_samples, n_features)
+        The design matrix
+    Y : array-like (n_samples, ) or (n_samples, n_bold)
+        The BOLD data, one col per fit
+    names : list, None
+        Names for the X cols (needed for t_test() and f_test())
+    bins : int, None
+        The AR(1) coefficient (rho) is estimated from each col's OLS 
+        residuals, then pooled.  If None, one rho (the mean) is used
+        for all cols, otherwise cols are pooled into bins equal 
+        width bins of rho. X is whitened and factored once per bin.
+    resid : bool
+        Also return the (unwhitened) residuals?
+
+    Return
+    ------
+    results : dict
+        As ols(), plus each col's pooled rho. If Y was 2d 
+        normalized_cov has a trailing pool axis, and codes gives
+        each col's pool.
+    """
+
+    X = np.asarray(X, dtype=float)
+    Y = np.asarray(Y, dtype=float)
+    if Y.ndim == 1:
+        return column(ar1(X, Y[:,np.newaxis], names, bins, resid), 0)
+
+    rhos, codes = _pool(_rho(ols(X, Y, resid=True)["resid"]), bins)
+    
+    # Y is whitened in one go, X and its 
+    # constant once for each pooled rho.
+    whiten_y = _whiten(Y, rhos[codes])
+    const = None
+    if np.any((np.ptp(X, axis=0) == 0) & np.any(X != 0, axis=0)):
+        const = np.ones(X.shape[0])
+
+    n_bold = Y.shape[1]
+    results = {}
+    for code, rho in enumerate(rhos):
+        cols = np.flatnonzero(codes == code)
+        fit = ols(_whiten(X, rho), whiten_y[:,cols], names=names, 
+                const=None if const is None else _whiten(const, rho))
+        for key, val in fit.items():
+            if key in _SHARED:
+                results[key] = val
+                continue
+            if key == "normalized_cov":
+                results.setdefault(key, []).append(val)
+                continue
+            if key not in results:
+                results[key] = np.zeros(val.shape[:-1] + (n_bold, ))
+            results[key][...,cols] = val
+    
+    results["normalized_cov"] = np.dstack(results["normalized_cov"])
+    results["codes"] = codes
+    results["rho"] = rhos[codes]
+    
+    # Add the whitening's Jacobian to the likelihood (as 
+    # in statsmodels GLS), so models with different rhos 
+    # can be compared.
+    results["llf"] = results["llf"] + 0.5 * np.log(1 - results["rho"] ** 2)
+    k = results["df_model"] + int(const is not None)
+    results["aic"] = -2 * results["llf"] + 2 * k
+    results["bic"] = -2 * results["llf"] + np.log(Y.shape[0]) * k
+    if resid:
+        results["resid"] = Y - X.dot(results["beta"])
+
+    return results
+
+
+def _rho(resid):
+    """Estimate the AR(1) coefficient of each resid col"""
+
+    return (resid[1:] * resid[:-1]).sum(axis=0) / (resid ** 2).sum(axis=0)
+
+
+def _pool(rho, bins):
+    """Pool rhos, returning the pooled values and each rho's code"""
+
+    rho = np.clip(rho, -0.99, 0.99)
+    if bins is None:
+        return np.array([rho.mean()]), np.zeros(rho.shape[0], dtype=int)
+
+    edges = np.linspace(rho.min(), rho.max(), bins + 1)
+    codes = np.unique(
+            np.digitize(rho, edges[1:-1]), return_inverse=True)[1]
+    rhos = np.bincount(codes, weights=rho) / np.bincount(codes)
+
+    return rhos, codes
+
+
+def _whiten(data, rho):
+    """Apply the (bidiagonal) AR(1) whitening operator to the
+    rows of data (Prais-Winsten). rho can be a scalar or one 
+    per col."""
+
+    whitened = np.empty(data.shape)
+    whitened[0] = np.sqrt(1 - rho ** 2) * data[0]
+    whitened[1:] = data[1:] - rho * data[:-1]
+
+    return whitened
+
+
+def ols_model(model, data, Y=None, resid=False, eval_env=0):
+    """Fit a patsy formula (e.g. 'bold ~ box + acc') with ols().
+
+    Parameters
+    ----------
+    model : str
+        The formula
+    data : DataFrame, dict
+        The data for the formula
+    Y : array-like, None
+        The BOLD data, (n_samples, ) or (n_samples, n_bold). If
+        None the left side of the model is taken from data, 
+        otherwise Y takes the place of the (one) variable the left 
+        side uses, so transforms like 'scale(bold)' are applied 
+        to each col of Y.
+    resid : bool
+        Also return the residuals?
+    eval_env : int
+        Which caller's namespace to evaluate the formula in; 0
+        is the function that called ols_model() (see patsy)
+    """
+
+    bold, X = design(model, data, eval_env=eval_env + 1)
+    Y = _bold(model, data, Y, EvalEnvironment.capture(eval_env + 1))
+
+    return ols(X, Y, names=X.design_info.column_names, resid=resid)
+
+
+def design(model, data, eval_env=0):
+    """Build the design matrix for the right side of a patsy formula
+    (e.g. 'bold ~ box + acc'), returning the left side's name and 
+    the matrix.
+
+    Formulas are parsed once per model string. If a formula has only
+    numerical terms and no stateful transforms (e.g. center() or 
+    scale(), which depend on the data) its DesignInfo is reused for 
+    new data, and the matrix is reused (read-only) when the data it 
+    uses has not changed.
+    """
+
+    if model not in _FORMULAS:
+        bold, dm = [mo.strip() for mo in model.split('~')]
+        desc = ModelDesc.from_formula(dm)
+        X = dmatrix(desc, data, eval_env=eval_env + 1)
+        
+        variables = _variables(X.design_info, data)
+        if variables is None:
+            _FORMULAS[model] = (bold, desc, None, None)
+        else:
+            _FORMULAS[model] = (bold, None, X.design_info, variables)
+            X.flags.writeable = False
+            _DESIGNS[(model, _token(data, variables))] = X
+
+        return bold, X
+
+    bold, desc, design_info, variables = _FORMULAS[model]
+    if design_info is None:
+        return bold, dmatrix(desc, data, eval_env=eval_env + 1)
+
+    key = (model, _token(data, variables))
+    if key in _DESIGNS:
+        return bold, _DESIGNS[key]
+
+    X = build_design_matrices([design_info], data)[0]
+    X.flags.writeable = False
+    _DESIGNS[key] = X
+
+    return bold, X
+
+
+def _bold(model, data, Y, eval_env):
+    """Evaluate the left side of the model, on data or, if it is not 
+    None, on Y (see ols_model())."""
+
+    if model not in _BOLDS:
+        desc = ModelDesc.from_formula(model)
+        variables = set()
+        for term in desc.lhs_termlist:
+            for factor in term.factors:
+                variables.update(_operands(factor.code))
+        _BOLDS[model] = (ModelDesc([], desc.lhs_termlist), variables)
+    desc, variables = _BOLDS[model]
+
+    if Y is not None:
+        if len(variables) != 1:
+            raise ValueError(
+                    "Y can only replace one variable in the left side")
+        
+        Y = np.asarray(Y, dtype=float)
+        data = {list(variables)[0] : Y}
+
+    bold = np.asarray(dmatrix(desc, data, eval_env=eval_env))
+    if (Y is None or Y.ndim == 1) and bold.shape[1] == 1:
+        bold = bold[:,0]
+
+    return bold
+
+
+def _operands(code):
+    """The names in a factor's code that are not functions 
+    or modules (e.g. bold in 'np.log(scale(bold))')"""
+
+    tree = ast.parse(code.strip(), mode='eval')
+    skip = set()
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Call):
+            skip.add(id(node.func))
+        elif isinstance(node, ast.Attribute):
+            skip.add(id(node.value))
+
+    return set(node.id for node in ast.walk(tree) 
+            if isinstance(node, ast.Name) and id(node) not in skip)
+
+
+def _variables(design_info, data):
+    """The (sorted) names in data a design uses, or None if the 
+    design can't be reused for new data.
+    
+    Designs that use variables from outside data (e.g. the caller's 
+    namespace) can't be reused, as those may change unseen."""
+
+    variables = set()
+    for factor, factor_info in design_info.factor_infos.items():
+        if factor_info.type != 'numerical':
+            return None
+        if factor_info.state.get('transforms'):
+            return None
+        try:
+            names = _operands(factor.code)
+        except AttributeError:
+            return None
+
+        if any(name not in data for name in names):
+            return None
+        variables.update(names)
+
+    return sorted(variables)
+
+
+def _token(data, variables):
+    """Hash the variables cols in data"""
+
+    sha = hashlib.sha1()
+    for name in variables:
+        col = np.asarray(data[name])
+        sha.update(name.encode('utf-8'))
+        sha.update(str((col.dtype, col.shape)).encode('utf-8'))
+        if col.dtype.kind == 'O':
+            sha.update(repr(col.tolist()).encode('utf-8'))
+        else:
+            sha.update(np.ascontiguousarray(col).tobytes())
+
+    return sha.hexdigest()
+
+
+def column(results, k):
+    """Get the results for the k-th BOLD col of a batched fit
+    (from ols(), t_test() or f_test())."""
+
+    col = dict(
+            (key, val if key in _SHARED else val[...,k])
+            for key, val in results.items() if key != "normalized_cov")
+    
+    # normalized_cov is shared, or (see ar1()) one per pool
+    if "normalized_cov" in results:
+        col["normalized_cov"] = results["normalized_cov"]
+        if "codes" in results:
+            col["normalized_cov"] = col["normalized_cov"][...,col["codes"]]
+
+    return col
+
+
+def _constraint(results, hypoth):
+    if results["names"] is None:
+        raise ValueError("Names are needed for hypothesis tests")
+
+    lc = DesignInfo(list(results["names"])).linear_constraint(hypoth)
+
+    effect = lc.coefs.dot(results["beta"])
+    if effect.ndim == 2:
+        effect = effect - lc.constants
+    else:
+        effect = effect - lc.constants.flatten()
+
+    return lc.coefs, effect
+
+
+def _contrast_cov(coefs, normalized_cov):
+    """coefs * normalized_cov * coefs' (for each pool, if 
+    normalized_cov is 3d, see ar1())"""
+
+    return np.einsum('ij,jl...,kl->ik...', coefs, normalized_cov, coefs)
+
+
+def t_test(results, hypoth):
+    """Run a t-test (for each BOLD col) of the hypothesis
+    (e.g. 'box = 0' or 'box - acc') on ols() or ar1() results."""
+
+    coefs, effect = _constraint(results, hypoth)
+
+    cov = _contrast_cov(coefs, results["normalized_cov"])
+    if cov.ndim == 2:
+        sd = np.sqrt(np.multiply.outer(np.diag(cov), results["mse_resid"]))
+    else:
+        sd = np.sqrt(
+                np.diagonal(cov)[results["codes"]].T * results["mse_resid"])
+    tvalue = effect / sd
+
+    return {
+        "effect" : effect,
+        "sd" : sd,
+        "tvalue" : tvalue,
+        "pvalue" : 2 * stats.t.sf(np.abs(tvalue), results["df_resid"]),
+        "df_denom" : results["df_resid"]
+    }
+
+
+def f_test(results, hypoth):
+    """Run a F-test (for each BOLD col) of the hypothesis
+    (e.g. 'box = 0, acc = 0') on ols() or ar1() results."""
+
+    coefs, effect = _constraint(results, hypoth)
+
+    cov = _contrast_cov(coefs, results["normalized_cov"])
+    if cov.ndim == 2:
+        wald = (effect * np.linalg.inv(cov).dot(effect)).sum(axis=0)
+    else:
+        inv_cov = np.linalg.inv(np.rollaxis(cov, 2))[results["codes"]]
+        wald = np.einsum('ik,kij,jk->k', effect, inv_cov, effect)
+    df_num = coefs.shape[0]
+    fvalue = wald / (df_num * results["mse_resid"])
+
+    return {
+        "fvalue" : fvalue,
+        "pvalue" : stats.f.sf(fvalue, df_num, results["df_resid"]),
+        "df_num" : df_num,
+        "df_denom" : results["df_resid"]
+    }
@@ -2,23 +2,57 @@
 import numpy as np
 import scipy.stats as stats
 from modelmodel.misc import process_prng
+from modelmodel.misc import LRUCache
 
 
-def double_gamma(width=32, TR=1, a1=6.0, a2=12., b1=0.9, b2=0.9, c=0.35):
+_KERNELS = LRUCache(maxsize=64)
+_FFTS = LRUCache(maxsize=64)
+
+
+def double_gamma(width=32, TR=1, a1=6.0, a2=12., b1=0.9, b2=0.9, c=0.35,
+        oversample=1):
     """
     Returns a HRF.  Defaults are the canonical parameters.
+
+    The HRF is sampled every TR / oversample. Kernels are cached, 
+    so the returned array is read-only; copy it before changing it.
     """
 
-    x_range = np.arange(0, width, TR)
+    key = tuple(float(par) for par in (width, TR, a1, a2, b1, b2, c)) + (
+            int(oversample), )
+    if key in _KERNELS:
+        return _KERNELS[key]
+
+    x_range = np.arange(0, width, float(TR) / oversample)
     d1 = a1 * b1
     d2 = a2 * b2
 
     hrf = ((x_range / d1) ** a1 * np.exp((d1 - x_range) / b1)) - (
             c * (x_range / d2) ** a2 *np.exp((d2 - x_range) / b2))
+    hrf.flags.writeable = False
+    _KERNELS[key] = hrf
 
     return hrf
 
 
+def kernel_fft(hrf, n_fft):
+    """
+    Returns the (cached, read-only) real FFT of the hrf, 
+    zero-padded to n_fft.
+    """
+
+    hrf = np.asarray(hrf, dtype=float)
+    key = (hrf.tobytes(), int(n_fft))
+    if key in _FFTS:
+        return _FFTS[key]
+
+    freq = np.fft.rfft(hrf, n_fft)
+    freq.flags.writeable = False
+    _FFTS[key] = freq
+
+    return freq
+
+
 def _preturb(weight, width=32, TR=1, a1=6.0, a2=12., b1=0.9, b2=0.9, c=0.35, prng=None):
     prng = process_prng(prng)
     np.random.set_state(prng.get_state())
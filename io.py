@@ -1,5 +1,4 @@
 """ Functions for reading and writing of model files and results """
-from copy import deepcopy
 import csv
 import h5py
 import ConfigParser
@@ -220,12 +219,22 @@ def write_all_scores_as_df(hdf5_name, code):
     fid.close()
 
 
-def reformat_model(smobject):
+def reformat_model(smobject, resid=False):
     """Extract many useful results from a statsmodel results
-    instance into a dict."""
+    instance into a dict. Results from glm.ols() are already a 
+    dict and are returned (shallow copied) as is.
+    
+    Values are referenced, not copied. The (bulky) residuals 
+    are only included if resid is True."""
 
     if smobject is None:
         return None
+    if isinstance(smobject, dict):
+        results = dict(smobject)
+        if not resid:
+            results.pop("resid", None)
+        
+        return results
     
     tosave = {
         "beta":"params",
@@ -235,7 +244,6 @@ def reformat_model(smobject):
         "r":"rsquared",
         "r_adj" : "rsquared_adj",
         "ci":"conf_int",
-        "resid":"resid",
         "aic":"aic",
         "bic":"bic",
         "llf":"llf",
@@ -243,27 +251,31 @@ def reformat_model(smobject):
         "mse_resid":"mse_resid",
         "mse_total":"mse_total"
     }
+    if resid:
+        tosave["resid"] = "resid"
     
-    # Try to get each attr (a value in the dict above)
-    # first as function (without args) then as a regular
-    # attribute.  If both fail, silently move on.
+    # Get each attr (a value in the dict above), calling 
+    # it if it is a method.  If it is missing, move on.
     results = {}
     for k, v in tosave.items():
-        try:
-            results[k] = deepcopy(getattr(smobject,v)())
-        except TypeError:
-            results[k] = deepcopy(getattr(smobject,v))
-        except AttributeError:
+        val = getattr(smobject, v, None)
+        if val is None:
             continue
+        if callable(val):
+            val = val()
+        results[k] = val
     
     return results
 
 
 def reformat_contrast(stato):
-    """Extract all public data from a ContrastResult object"""
+    """Extract all public data from a ContrastResult object 
+    (or a glm.t_test()/f_test() dict)"""
     
     if stato is None:
         return None
+    if isinstance(stato, dict):
+        return dict(stato)
     
     # Get public attr names
     # And store return in a dict
@@ -278,13 +290,12 @@ def reformat_contrast(stato):
     return stat_results
 
     
-def merge_results(name, model, smo, df=None, stato=None, other=None):
+def merge_results(name, model, smo, df=None, stato=None, other=None, 
+        resid=False):
     """Merge disparate results objects and dicts into a single dict
-    suitable for saving."""
+    suitable for saving. Residuals are only kept if resid is True."""
 
-    
-    glm_results = reformat_model(smo)
-    results = deepcopy(glm_results)
+    results = reformat_model(smo, resid=resid)
     
     stat_results = reformat_contrast(stato)
     results['tests'] = stat_results
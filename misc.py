@@ -1,5 +1,6 @@
 """ Who knows what, really.  The miscellaneous goes here."""
 import numpy as np
+from collections import OrderedDict
 
 
 def process_prng(prng):
@@ -19,3 +20,47 @@ def process_prng(prng):
     
     return prng
 
+
+
+class LRUCache(object):
+    """ A dict-like cache holding at most <maxsize> items.  When full
+    the least recently used item is dropped first. """
+
+    def __init__(self, maxsize=128):
+        self.maxsize = maxsize
+        self._items = OrderedDict()
+
+    def __contains__(self, key):
+        return key in self._items
+
+    def __len__(self):
+        return len(self._items)
+
+    def __getitem__(self, key):
+        # Move key to the end, 
+        # marking it as most recent.
+        value = self._items.pop(key)
+        self._items[key] = value
+
+        return value
+
+    def __setitem__(self, key, value):
+        if key in self._items:
+            self._items.pop(key)
+        self._items[key] = value
+        
+        while len(self._items) > self.maxsize:
+            self._items.popitem(last=False)
+
+    def get(self, key, default=None):
+        """ Return the value for <key> if cached, else <default>. """
+        
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def clear(self):
+        """ Empty the cache. """
+
+        self._items.clear()
@@ -1,39 +1,74 @@
 """ Use atlases to create ROI masks. """
 import os
+import gzip
 import nibabel as nb
 import numpy as np
 import roi
+from io import BytesIO
 from zipfile import ZipFile
 from roi.io import write_nifti, read_nifti
-    
+from modelmodel.misc import LRUCache
+from modelmodel.roi.pre import RoiData
+
+
+_INDEXES = LRUCache(maxsize=8)
+_ROIS = LRUCache(maxsize=1024)
+_ZIPS = {}
+_UNZIPPED = '.unzipped'
+
 
 def get_roi(atlas, name):
-    """ Get the an roi (a nifti1 object) by <name> from <atlas>. """
+    """ Get the an roi (as RoiData) by <name> from <atlas>. 
     
-    # Set the path for the named roi
-    # and try to open it.
-    path = os.path.join(roi.__path__[0], 'atlases', atlas, 'rois', name)
-    try:
-        nifti = read_nifti(path)
-
-        # If name can't be loaded you may need to run
-        # create_rois, tell the user that.
-    except IOError, err:
-        print("Could not load <name>. Try create_rois() or open_atlases()")
-        raise IOError(err)
+    If the atlas has an index (see create_index()) the roi comes 
+    from that, otherwise from its nifti1 file.  Either way rois are 
+    cached once loaded. 
+    
+    Atlases are read from disk if open_atlases() has been run, 
+    otherwise only the files needed are read straight from the 
+    atlases zip file. 
     
-    return nifti
+    Note: this returns RoiData, not a nibabel object as it once 
+    did; use get_roi(atlas, name).to_nifti() for a nifti1 mask 
+    (see pre.RoiData). """
+    
+    key = (atlas, name)
+    if key in _ROIS:
+        return _ROIS[key]
+
+    index = _load_index(atlas)
+    if index is not None:
+        try:
+            roidata = _index_roi(index, name.replace('.nii', ''))
+        except KeyError:
+            raise IOError("{0} is not in the {1} index".format(name, atlas))
+    else:
+        roidata = _nifti_roi(atlas, name)
+
+    _ROIS[key] = roidata
+
+    return roidata
 
 
 def open_atlases():
-    """ Uncompress the atlases file. """
+    """ Uncompress the atlases file.  
+    
+    This is optional; without it atlas files are read from the 
+    zip file as needed. """
     
-    if not os.path.exists(os.path.join(roi.__path__[0], 'atlases')):
-        print("Unzipping atlases in {0}.".format(
-                os.path.join(roi.__path__[0], 'atlases')))
+    path = os.path.join(roi.__path__[0], 'atlases')
+    marker = os.path.join(path, _UNZIPPED)
+        ## The atlases directory alone is no sign of 
+        ## an unzip, create_rois() and create_index() 
+        ## make it too
+    if not os.path.exists(marker):
+        print("Unzipping atlases in {0}.".format(path))
         
         unzme = ZipFile(os.path.join(roi.__path__[0], 'atlases.zip'))
         unzme.extractall(path=roi.__path__[0])
+        unzme.close()
+        
+        open(marker, 'w').close()
 
 
 def create_rois(atlas, base, legend):
@@ -43,36 +78,30 @@ def create_rois(atlas, base, legend):
 
     # setup pathing, read in the process the base
     path = os.path.join(roi.__path__[0], 'atlases')
-    loni = read_nifti(os.path.join(path, atlas, base))
+    loni = _read_atlas_nifti(atlas, base)
 
     # Need these for writing the rois out later
     header = loni.get_header()
     affline = loni.get_affine()
     data = loni.get_data()
 
-    # And get then the txt file that is its legend.
-    fhandle = open(os.path.join(path, legend))
-    fdata = [line.strip().split(':') for line in fhandle]
-
-    # Store the legend data in a dict keyed
-    # on the ROI names.
-    legend_dict = {}
-    for col1, col2 in fdata:
-        legend_dict.update({col2 : int(col1)})
+    legend_dict = _read_legend(legend)
     
     # Loop over the legend, creating and 
     # saving a nii file for each item.
     roi_path = os.path.join(path, atlas, 'rois')
     if not os.path.exists(roi_path):
-        os.mkdir(roi_path)
+        os.makedirs(roi_path)
 
-    for key, val in legend_dict.items():
-        # Mask based on v, the index for he current
+    names = legend_dict.keys()
+    indices = _label_index(data, [legend_dict[key] for key in names])
+    for key, index in zip(names, indices):
+        # Mask based on index, the voxels for the current
         # roi then create the binary roi.
         mask = np.zeros(data.shape, dtype=np.uint8)
             ## nifti1 needs unsigned integers
 
-        mask[data == val] = 1
+        mask.flat[index] = 1
 
         # Finally, create a nifti object and write 
         # it using the key from legend as a name.
@@ -82,4 +111,182 @@ def create_rois(atlas, base, legend):
             ## Not sure this does anything,
             ## but just in case
 
-        write_nifti(nifti, os.path.join(path, atlas, 'rois', niftiname))
\ No newline at end of file
+        write_nifti(nifti, os.path.join(path, atlas, 'rois', niftiname))
+
+
+def create_index(atlas, base, legend):
+    """ Creates a compact index of every roi in <atlas> (see 
+    create_rois() for <base> and <legend>), saving it as
+    index.npz in the atlas directory.  
+    
+    The index holds the flat (C order) voxel indices of all rois 
+    and the atlas affine and shape, which get_roi() then uses in 
+    place of the per-roi nifti1 files. """
+
+    path = os.path.join(roi.__path__[0], 'atlases', atlas)
+    if not os.path.exists(path):
+        os.makedirs(path)
+    
+    loni = _read_atlas_nifti(atlas, base)
+    data = loni.get_data()
+
+    legend_dict = _read_legend(legend)
+    names = sorted(legend_dict.keys())
+    indices = _label_index(data, [legend_dict[key] for key in names])
+
+    offsets = np.cumsum([0] + [index.shape[0] for index in indices])
+    np.savez(
+            os.path.join(path, 'index.npz'),
+            names=np.array(names),
+            offsets=offsets,
+            indices=np.concatenate(indices),
+            affine=loni.get_affine(),
+            shape=np.array(data.shape[0:3]))
+
+    # Drop any stale cached copy
+    _INDEXES.clear()
+    _ROIS.clear()
+
+
+def _nifti_roi(atlas, name):
+    """ Get the named roi from its nifti1 file. """
+
+    # Try to open the named roi.
+    try:
+        nifti = _read_atlas_nifti(atlas, 'rois', name)
+
+        # If name can't be loaded you may need to run
+        # create_rois, tell the user that.
+    except IOError, err:
+        print("Could not load <name>. Try create_rois() or open_atlases()")
+        raise IOError(err)
+    
+    return RoiData(
+            np.flatnonzero(nifti.get_data() == 1), nifti.get_affine(), 
+            nifti.shape)
+
+
+def _index_roi(index, name):
+    """ Get the named roi from an atlas <index> (see _load_index()) """
+
+    pos = index['positions'][name]
+    start, stop = index['offsets'][pos:pos+2]
+
+    return RoiData(
+            index['indices'][start:stop], index['affine'], index['shape'])
+
+
+def _load_index(atlas):
+    """ Load the (cached) index for <atlas>, returning None if
+    there isn't one. """
+
+    if atlas in _INDEXES:
+        return _INDEXES[atlas]
+
+    try:
+        fhandle = _atlas_file(atlas, 'index.npz')
+    except IOError:
+        return None
+    
+    stored = np.load(fhandle)
+    index = {
+            'names' : stored['names'],
+            'offsets' : stored['offsets'],
+            'indices' : stored['indices'],
+            'affine' : stored['affine'],
+            'shape' : tuple(stored['shape']),
+            }
+    index['positions'] = dict(
+            (str(name), pos) for pos, name in enumerate(index['names']))
+    stored.close()
+    fhandle.close()
+
+    _INDEXES[atlas] = index
+
+    return index
+
+
+def _read_legend(name):
+    """ Read a legend file, returning a dict of roi codes keyed 
+    on the ROI names. """
+
+    # And get then the txt file that is its legend.
+    fhandle = _atlas_file(name)
+    fdata = [line.decode().strip().split(':') for line in fhandle]
+    fhandle.close()
+
+    # Store the legend data in a dict keyed
+    # on the ROI names.
+    legend_dict = {}
+    for col1, col2 in fdata:
+        legend_dict.update({col2 : int(col1)})
+
+    return legend_dict
+
+
+def _label_index(data, codes):
+    """ Find the voxels for each of <codes> in <data> (a label 
+    volume) in one pass, by sorting the labels.
+    
+    Returns a list of flat (C order) voxel index arrays, 
+    one for each code. """
+
+    labels = np.asarray(data).ravel()
+    order = np.argsort(labels, kind='mergesort')
+        ## Stable, so each index 
+        ## stays sorted
+    sorted_labels = labels[order]
+
+    codes = np.asarray(codes)
+    starts = np.searchsorted(sorted_labels, codes, side='left')
+    stops = np.searchsorted(sorted_labels, codes, side='right')
+
+    return [order[start:stop] for start, stop in zip(starts, stops)]
+
+
+def _atlas_file(*parts):
+    """ Open the atlas file at <parts> (path components inside the 
+    atlases directory) for reading in binary mode.  
+    
+    The file is read from disk if the atlases have been unzipped, 
+    otherwise only that file is read from the atlases zip file. """
+
+    path = os.path.join(roi.__path__[0], 'atlases', *parts)
+    if os.path.exists(path):
+        return open(path, 'rb')
+    
+    member = '/'.join(('atlases', ) + parts)
+    try:
+        return BytesIO(_atlas_zip().read(member))
+    except KeyError:
+        raise IOError("{0} not found on disk or in the atlases zip".format(
+                member))
+
+
+def _atlas_zip():
+    """ The (cached) atlases zip file. 
+    
+    Each process gets its own handle, as a shared file position 
+    would be unsafe. """
+
+    key = os.getpid()
+    if key not in _ZIPS:
+        _ZIPS[key] = ZipFile(os.path.join(roi.__path__[0], 'atlases.zip'))
+
+    return _ZIPS[key]
+
+
+def _read_atlas_nifti(*parts):
+    """ Read the nifti1 atlas file at <parts> (see _atlas_file()). """
+    
+    path = os.path.join(roi.__path__[0], 'atlases', *parts)
+    if os.path.exists(path):
+        return read_nifti(path)
+
+    fileobj = _atlas_file(*parts)
+    if parts[-1].endswith('.gz'):
+        fileobj = BytesIO(gzip.GzipFile(fileobj=fileobj).read())
+
+    holder = nb.FileHolder(fileobj=fileobj)
+    
+    return nb.Nifti1Image.from_file_map({'header' : holder, 'image' : holder})
@@ -1,11 +1,25 @@
 """ A module for selecting voxels from within ROIs """
+import os
+import shutil
+import hashlib
+import tempfile
+import multiprocessing
 import numpy as np
 import nibabel as nb
 from roi.io import read_nifti
+from modelmodel.misc import LRUCache
+from modelmodel.misc import process_prng
 
 
-def combine4d(niftis):
+def combine4d(niftis, filename=None):
     """Combine the list of nifti objects along their 4th axis.
+
+    The combined shape is worked out from the headers, space for it 
+    is allocated once and each nifti is copied into place.  If 
+    <filename> is given, that space is a memory-mapped nifti1 file 
+    (which is also returned) so the combined data never needs to fit 
+    in memory. Only uncompressed single files ('.nii') can be 
+    memory-mapped.
     
     Note:
     ----
@@ -17,12 +31,58 @@ def combine4d(niftis):
     of 10x10x10x20, the desired result.
     """
 
-    # Init then join.
-    combine_nifti = niftis.pop(0)
+    if (filename is not None) and (not filename.endswith('.nii')):
+        raise ValueError("filename must end with .nii")
+
+    first = niftis[0]
+    shape3d = first.shape[0:3]
+    
+    # Get the size of the final 4th axis, 
+    # and a dtype that fits all the data.
+    n_vols = []
     for nifti in niftis:
-        combine_nifti = join_time(combine_nifti, nifti)
+        if nifti.shape[0:3] != shape3d:
+            raise ValueError("x, y, z shapes of the niftis don't match")
+        n_vols.append(nifti.shape[3] if len(nifti.shape) > 3 else 1)
+
+    dtype = np.result_type(*[_data_dtype(nifti) for nifti in niftis])
+    shape = shape3d + (sum(n_vols), )
+    
+    header = nb.Nifti1Header.from_header(first.get_header())
+        ## A single file (n+1) header, even 
+        ## if first was a .hdr/.img pair
+    header.set_data_shape(shape)
+    header.set_data_dtype(dtype)
+    header.set_slope_inter(1, 0)
+        ## Any scaling has been 
+        ## applied already.
+    
+    if filename is None:
+        joined = np.empty(shape, dtype=dtype)
+    else:
+        joined = _memmap_nifti(filename, header)
+    
+    # Copy each nifti into place.
+    start = 0
+    for nifti, n_vol in zip(niftis, n_vols):
+        data = _get_data(nifti)
+        if data.ndim == 3:
+            data = data[...,np.newaxis]
+                ## Add a dummy 4th d
+        joined[...,start:start+n_vol] = data
+        start += n_vol
+    
+    if filename is not None:
+        joined.flush()
+        del joined
+
+        return nb.load(filename)
 
-    return combine_nifti
+    # Convert to a nifti object
+    asnifti = nb.Nifti1Image(joined, affine=first.get_affine(), header=header)
+    asnifti.update_header()
+
+    return asnifti
 
 
 def join_time(nifti1, nifti2):
@@ -30,53 +90,385 @@ def join_time(nifti1, nifti2):
     volumes or TRs). Note: affline and header data is inherited from
     nifti1. """
 
-    # Get the data for nifti1 and 2,
-    data1 = nifti1.get_data()
-    shape1 = data1.shape
+    return combine4d([nifti1, nifti2])
 
-    data2 = nifti2.get_data()
-    shape2 = data2.shape
 
-    joined = np.array([])     ## Init
+def _data_dtype(nifti):
+    """ The dtype of the data in <nifti> once any scaling in the 
+    header is applied. """
 
-    # and join it.
-    try:
-        joined = np.append(data1, data2, 3)
-    except ValueError:
-        # If nifti1 or 2 is only 3d the above errors
-        # so add a dummy 4th,
-        if len(shape1) == 3:
-            data1.reshape((data1.shape + (1,)))
+    dtype = nifti.get_data_dtype()
 
-        if len(shape2) == 3:
-            data2.reshape((data2.shape + (1,)))
+    dataobj = nifti.dataobj
+    if (getattr(dataobj, 'slope', 1) != 1) or (
+            getattr(dataobj, 'inter', 0) != 0):
+        dtype = np.result_type(dtype, np.float64)
+
+    return dtype
+
+
+def _memmap_nifti(filename, header):
+    """ Create a (single) nifti1 file <filename> using <header>, 
+    returning a writable memory-map of its (still empty) data. """
+    
+    header = header.copy()
+    header['vox_offset'] = 0
+        ## Let nibabel set it
+    
+    shape = header.get_data_shape()
+    dtype = header.get_data_dtype()
+    
+    fhandle = open(filename, 'wb')
+    header.write_to(fhandle)
+    offset = fhandle.tell()
+    
+    # Grow the file to its full size
+    fhandle.seek(offset + int(np.prod(shape)) * dtype.itemsize - 1)
+    fhandle.write(b'\0')
+    fhandle.close()
+    
+    return np.memmap(
+            filename, dtype=dtype, mode='r+', offset=offset, 
+            shape=shape, order='F')
+
+
+class Runs(object):
+    """ A lazy view of several nifti runs as one 4d dataset, joined 
+    along the 4th axis (time). 
+    
+    Nothing is read until the data is indexed, and then only the 
+    runs (and voxels) that were asked for.  Runs can be used in place
+    of a nibabel object by mask(), extract(), mask_many(), 
+    num_active_voxels() and combine4d().
+
+    Parameters
+    ----------
+    niftis : list
+        A list of nibabel objects, or the names of nifti1 files.
         
-        # then try again.
-        joined = np.append(data1, data2, 3)
+    Note
+    ----
+    As in combine4d(), the header (and affine) of the first nifti 
+    are used for the rest.
+    """
 
-    # Convert to a nifti object
-    asnifti = nb.Nifti1Image(
-            joined, affine=nifti1.get_affine(), header=nifti1.get_header())
-    asnifti.update_header()
+    def __init__(self, niftis):
+        self.niftis = [
+                nifti if hasattr(nifti, 'get_header') else nb.load(nifti) 
+                for nifti in niftis]
+        
+        shape3d = self.niftis[0].shape[0:3]
+        n_vols = []
+        for nifti in self.niftis:
+            if nifti.shape[0:3] != shape3d:
+                raise ValueError("x, y, z shapes of the niftis don't match")
+            n_vols.append(nifti.shape[3] if len(nifti.shape) > 3 else 1)
+        
+        self.starts = np.cumsum([0] + n_vols)
+        self.shape = shape3d + (int(self.starts[-1]), )
+        self.ndim = 4
+        self.dtype = np.result_type(
+                *[_data_dtype(nifti) for nifti in self.niftis])
 
-    return asnifti
+    @property
+    def dataobj(self):
+        return self
+
+    def get_header(self):
+        return self.niftis[0].get_header()
+
+    def get_affine(self):
+        return self.niftis[0].get_affine()
+
+    def get_data_dtype(self):
+        return self.dtype
+
+    def get_data(self):
+        """ Read all the data (use with care). """
+        
+        return self[...]
+
+    def to_nifti(self, filename=None):
+        """ Join the runs into a single nibabel object (see 
+        combine4d()). """
+        
+        return combine4d(self.niftis, filename)
+
+    def __array__(self, dtype=None):
+        data = self[...]
+        if dtype is not None:
+            data = data.astype(dtype)
+
+        return data
+
+    def __getitem__(self, key):
+        spatial, time = self._split(key)
+        
+        vols = np.arange(self.shape[3])[time]
+        scalar = np.ndim(vols) == 0
+        
+        # Ints would drop axes before the time axis is
+        # indexed, so use length-1 slices and drop them at
+        # the end; basic indexing is then possible.
+        fancy = any(not isinstance(k, (slice, int, np.integer)) 
+                for k in spatial)
+        if fancy and not isinstance(time, (slice, int, np.integer)):
+            return self._points(spatial, vols)
+        vols = np.atleast_1d(vols)
+
+        drop = tuple(i for i, k in enumerate(spatial) 
+                if isinstance(k, (int, np.integer)))
+        for i in drop:
+            if not -self.shape[i] <= spatial[i] < self.shape[i]:
+                raise IndexError("index out of bounds")
+        if not fancy:
+            spatial = tuple(
+                    slice(k % n, k % n + 1) if i in drop else k 
+                    for i, (k, n) in enumerate(zip(spatial, self.shape)))
+                ## % wraps negative ints, so -1 is the last
+
+        # Read each run needed, in run order, 
+        # then put vols back in the order asked.
+        run_of = np.searchsorted(self.starts, vols, side='right') - 1
+        order = np.argsort(run_of, kind='mergesort')
+        
+        parts = []
+        for run in np.unique(run_of):
+            local = vols[run_of == run] - self.starts[run]
+            if fancy:
+                data = self._read(run, (slice(None), ) * 3, local)
+                parts.append(data[spatial][...,local - local.min()])
+            else:
+                data = self._read(run, spatial, local)
+                parts.append(data[...,local - local.min()])
+        
+        joined = np.empty(
+                parts[0].shape[0:-1] + (vols.shape[0], ), 
+                dtype=np.result_type(*parts))
+        joined[...,order] = np.concatenate(parts, axis=-1)
+        
+        if not fancy:
+            joined = joined.reshape(tuple(n for i, n in 
+                    enumerate(joined.shape) if i not in drop))
+        if scalar:
+            joined = joined[...,0]
+
+        return joined
+
+    def _points(self, spatial, vols):
+        """ Index pointwise (as numpy does) when the spatial and
+        time indices are all arrays (or ints). """
+
+        if any(isinstance(k, slice) for k in spatial):
+            raise IndexError(
+                    "slices can't be mixed with array indices over time")
+        
+        points = np.broadcast_arrays(*(tuple(
+                np.asarray(k) % n for k, n in zip(spatial, self.shape)) + (
+                vols, )))
+        run_of = np.searchsorted(self.starts, points[3], side='right') - 1
+        
+        joined = None
+        for run in np.unique(run_of):
+            at = run_of == run
+            local = points[3][at] - self.starts[run]
+            data = self._read(run, (slice(None), ) * 3, local)
+            values = data[tuple(p[at] for p in points[0:3]) + (
+                    local - local.min(), )]
+            
+            if joined is None:
+                joined = np.empty(points[3].shape, dtype=self.dtype)
+            joined[at] = values
+
+        return joined
+
+    def _read(self, run, spatial, local):
+        """ Read the <spatial> (basic) index of <run>, for the 
+        vols from the first to the last of <local>, through the 
+        nibabel array proxy so only that much is read. """
+
+        nifti = self.niftis[run]
+        dataobj = getattr(nifti, 'dataobj', None)
+        if dataobj is None:
+            dataobj = nifti.get_data()
+                ## Older nibabel
+        
+        if len(nifti.shape) == 3:
+            return np.asarray(dataobj[spatial])[...,np.newaxis]
+        
+        return np.asarray(
+                dataobj[spatial + (slice(local.min(), local.max() + 1), )])
+
+    def _split(self, key):
+        """ Split an index <key> into its spatial (x, y, z) and
+        time parts. """
+
+        if not isinstance(key, tuple):
+            key = (key, )
+        
+        # Boolean masks index as their nonzero() 
+        # indices, one per axis they cover.
+        expanded = ()
+        for k in key:
+            if getattr(k, 'dtype', None) == bool and np.ndim(k) > 0:
+                expanded += np.nonzero(k)
+            else:
+                expanded += (k, )
+        key = expanded
+
+        is_ellipsis = [k is Ellipsis for k in key]
+        if any(is_ellipsis):
+            at = is_ellipsis.index(True)
+            fill = (slice(None), ) * (4 - len(key) + 1)
+            key = key[0:at] + fill + key[at+1:]
+        key = key + (slice(None), ) * (4 - len(key))
+        
+        if len(key) != 4:
+            raise IndexError("too many indices")
+
+        return key[0:3], key[3]
 
 
 def num_active_voxels(nifti):
-    """ Returns the number of voxels in the first volume of <nifti>. """
+    """ Returns the number of voxels in the first volume of <nifti>
+    (a nibabel object or RoiData). """
 
     # Assume 3d, but if 4d 
     # only keep first vol. 
-    vol = nifti.get_data()
-    if vol.ndim > 3:
-        vol = vol[...,0]
+    if isinstance(nifti, RoiData):
+        vol = nifti.data[:,0]
+    else:
+        vol = _get_data(nifti)
+        if vol.ndim > 3:
+            vol = vol[...,0]
 
     return np.sum(vol > 0.01)
 
 
-def mask(nifti, roi, standard=True):
+def summarize(roidatas, threshold=0.01, k=None):
+    """ Summarize each of <roidatas> (a list of RoiData) over its 
+    voxels, for every volume, in one pass.
+
+    Returns a dict of (n_rois, n_vols) arrays:
+    
+    * 'n_active' : the number of voxels > <threshold> 
+        (see num_active_voxels())
+    * 'mean', 'median', 'var' : the mean, median and variance 
+        of the voxels
+    
+    If <k> is not None 'top_var' is also returned, a list of the flat 
+    indices (see RoiData) of the <k> voxels in each roi with the 
+    highest variance over time.  Empty rois give nan. """
+
+    if isinstance(roidatas, RoiData):
+        roidatas = [roidatas, ]
+
+    data, starts, counts = _stack(roidatas)
+    roi_ids = np.repeat(np.arange(len(roidatas)), counts)
+    
+    with np.errstate(invalid='ignore', divide='ignore'):
+        n = counts[:,np.newaxis].astype(float)
+        n[n == 0] = np.nan
+
+        summary = {}
+        summary['n_active'] = _segment_sum(data > threshold, starts, counts)
+        summary['mean'] = _segment_sum(data, starts, counts) / n
+        
+        deviance = (data - summary['mean'][roi_ids]) ** 2
+        summary['var'] = _segment_sum(deviance, starts, counts) / n
+        
+        summary['median'] = _segment_median(data, roi_ids, starts, counts)
+
+    if k is not None:
+        voxel_var = data.var(axis=1)
+        summary['top_var'] = [
+                roidata.index[_top_k(voxel_var[start:stop], k)] 
+                for roidata, start, stop 
+                in zip(roidatas, starts, starts + counts)]
+
+    return summary
+
+
+class RoiData(object):
+    """ The voxels of an ROI, stored compactly. 
+    
+    Parameters
+    ----------
+    index : array-like
+        Flat (C order) indices of the ROI voxels in a volume of <shape>
+    affine : array-like (4, 4)
+        The affine matrix of that volume
+    shape : sequence
+        The (x, y, z) shape of that volume
+    data : array-like (n_voxels, n_vols), None
+        The data for each voxel in index (optional)
+    header : nibabel header, None
+        A header to use in to_nifti() (optional)
+    """
+
+    def __init__(self, index, affine, shape, data=None, header=None):
+        self.index = np.asarray(index)
+        self.affine = np.asarray(affine)
+        self.shape = tuple(shape[0:3])
+        self.data = data
+        self.header = header
+
+        if (data is not None) and (data.shape[0] != self.index.shape[0]):
+            raise ValueError("data and index have different n_voxels")
+
+    def __len__(self):
+        return self.index.shape[0]
+
+    @property
+    def ijk(self):
+        """ The x, y, z coordinates of each voxel (as a 2d column 
+        oriented array). """
+        
+        return np.array(np.unravel_index(self.index, self.shape)).transpose()
+
+    @property
+    def n_vol(self):
+        return self.data.shape[1]
+
+    def mean(self):
+        """ The mean timecourse of the ROI. """
+
+        if len(self) == 0:
+            return np.repeat(np.nan, self.n_vol)
+
+        return self.data.mean(axis=0)
+
+    def to_nifti(self, dtype=None):
+        """ Convert to a (full-size, 4d) nibabel object, zero outside 
+        the ROI.  If <dtype> is None, the dtype of data is used. 
+        
+        Without data, this is a 3d binary (1 in the ROI) mask, 
+        uint8 unless <dtype> is given. """
+
+        if self.data is None:
+            vol = np.zeros(self.shape, dtype=dtype or np.uint8)
+                ## nifti1 needs unsigned integers
+            vol.flat[self.index] = 1
+        else:
+            if dtype is None:
+                dtype = self.data.dtype
+
+            vol = np.zeros(self.shape + (self.n_vol, ), dtype=dtype)
+            ijk = np.unravel_index(self.index, self.shape)
+            vol[ijk] = self.data
+
+        nifti = nb.Nifti1Image(vol, self.affine, self.header)
+        nifti.set_data_dtype(vol.dtype)
+            ## Or the header's dtype 
+            ## is used on save
+
+        return nifti
+
+
+def mask(nifti, roi, standard=True, dtype=None):
     """ Mask and return the data in <nifti> with that in <roi> 
-    (both should be nibabel obejcts). <roi> should be binary. 
+    (both should be nibabel obejcts, though <roi> can also be 
+    RoiData). <roi> should be binary. 
     
     If <standard> is True (default) the q_form affine matrix is used.  
     If false, the s_form is used.
@@ -89,98 +481,508 @@ def mask(nifti, roi, standard=True):
     as well as
        
        http://nifti.nimh.nih.gov/dfwg/presentations/nifti-1-rationale 
+
+    The data keeps the dtype of <nifti> unless <dtype> is given.
+
+    Note: extract() returns the same data as compact RoiData.
     """
 
-    # -- 
-    # Create nifti and roi meta-data
-    nifti_head = nifti.get_header()
-    roi_head = roi.get_header()
+    return extract(nifti, roi, standard, dtype).to_nifti()
+
+
+def extract(nifti, roi, standard=True, dtype=None):
+    """ Mask the data in <nifti> with that in <roi> (see mask()), 
+    returning RoiData. """
+
+    return mask_many(nifti, [roi], standard, dtype=dtype)[0]
+
 
-    if standard:
-        roi_affine = roi_head.get_qform()
-        nifti_affine = nifti_head.get_qform()
+def mask_many(nifti, rois, standard=True, mean=False, dtype=None, 
+        n_jobs=1):
+    """ Mask the data in <nifti> with each of <rois> (a list of 
+    binary nibabel objects, or RoiData) reading the data only once.
+    
+    Returns a list of RoiData, one for each roi, or if <mean> 
+    is True a (n_rois, n_vols) array of the mean timecourse 
+    for each roi.
+
+    If <n_jobs> is more than 1, the rois are split over a pool
+    of that many processes, which share the data as a memory-map.
+    The order of the results is unchanged.
+
+    See mask() for <standard> and <dtype>. """
+
+    nifti_affine = _affines(nifti, None, standard)[0]
+    nifti_shape = nifti.shape[0:3]
+
+    if n_jobs > 1:
+        split = _mask_parallel(nifti, rois, standard, dtype, n_jobs)
     else:
-        roi_affine = roi_head.get_sform()        
-        nifti_affine = nifti_head.get_sform()
+        indices = [_roi_index(nifti, roi, standard) for roi in rois]
+        
+        # Pull every voxel needed from the data in one go, 
+        # then split that up by roi.
+        union = np.unique(np.concatenate(
+                [np.array([], dtype=int)] + indices))
+        
+        nifti_data = _get_data(nifti)
+        voxels = nifti_data[np.unravel_index(union, nifti_shape)]
+        if voxels.ndim == 1:
+            voxels = voxels[:,np.newaxis]
+                ## 3d data, so add a 
+                ## vol axis
+        if dtype is not None:
+            voxels = voxels.astype(dtype)
+        
+        split = [(index, voxels[np.searchsorted(union, index)]) 
+                for index in indices]
+    
+    masked = [
+            RoiData(index, nifti_affine, nifti_shape, data, 
+                    nifti.get_header()) for index, data in split]
+    if mean:
+        masked = np.array([roidata.mean() for roidata in masked])
 
-    nifti_data = nifti.get_data().astype('int16')
-    nifti_shape = nifti.shape
+    return masked
 
-    # --
-    # Deal with nifti_data being 3d
-    # *or* 4d
-    if len(nifti_shape) > 3:
-        # When 4d:
-        n_vol = nifti_shape[3]
-        nifti_shape = nifti_shape[0:3]
-            ## We only want x,y,z -> 0,1,2
+
+def _stack(roidatas):
+    """ Stack the data in <roidatas> into one (n_voxels, n_vols) 
+    array, returning it along with the start and count of each 
+    roi's rows. """
+
+    counts = np.array([len(roidata) for roidata in roidatas])
+    starts = np.cumsum(counts) - counts
+    data = np.concatenate(
+            [roidata.data.astype(float) for roidata in roidatas], axis=0)
+
+    return data, starts, counts
+
+
+def _segment_sum(data, starts, counts):
+    """ Sum the rows of <data> (2d) in each segment of rows 
+    (given by <starts> and <counts>). Segments are summed 
+    separately, so a nan stays in its own segment. """
+
+    summed = np.zeros((counts.shape[0], data.shape[1]))
+    has = counts > 0
+    if np.any(has):
+        summed[has] = np.add.reduceat(
+                data.astype(float), starts[has], axis=0)
+            ## Empty segments are dropped, as 
+            ## reduceat would return a row for them
+
+    return summed
+
+
+def _segment_median(data, segment_ids, starts, counts):
+    """ The median of each column of <data> (2d) in each segment
+    of rows (given by <segment_ids>, <starts> and <counts>). """
+    
+    if data.shape[0] == 0:
+        return np.zeros((counts.shape[0], data.shape[1])) * np.nan
+    
+    # Shift each segment so its values are all larger than 
+    # the last's, then one sort (per column) sorts within 
+    # every segment at once. Nans are put at the top of 
+    # their own segment, and their medians set to nan.
+    nans = np.isnan(data)
+    finite = data[~nans]
+    low, high = (finite.min(), finite.max()) if finite.size else (0.0, 0.0)
+    span = high - low + 1.0
+    offsets = segment_ids[:,np.newaxis] * span
+    ordered = np.sort(
+            np.where(nans, span - 0.5, data - low) + offsets, axis=0)
+
+    has = counts > 0
+    lower = ordered[starts[has] + (counts[has] - 1) // 2]
+    upper = ordered[starts[has] + counts[has] // 2]
+    
+    median = np.zeros((counts.shape[0], data.shape[1])) * np.nan
+    median[has] = (lower + upper) / 2.0 - (
+            np.arange(counts.shape[0])[has,np.newaxis] * span) + low
+    median[_segment_sum(nans, starts, counts) > 0] = np.nan
+    
+    return median
+
+
+def _top_k(values, k):
+    """ The index of the <k> largest <values> (1d), in descending 
+    order, found by partial sort. """
+    
+    values = np.asarray(values)
+    k = min(k, values.shape[0])
+    if k <= 0:
+        return np.array([], dtype=int)
+
+    top = np.argpartition(values, values.shape[0] - k)[-k:]
+
+    return top[np.argsort(values[top])[::-1]]
+
+
+def _get_data(nifti):
+    """ Get the data in <nifti> in its native dtype, without copying
+    or caching it.  Where the file allows, nibabel returns a 
+    memory-map so only the voxels actually indexed are read. """
+
+    if isinstance(nifti, Runs):
+        return nifti
+            ## Keep it lazy
+
+    try:
+        return np.asanyarray(nifti.dataobj)
+    except AttributeError:
+        return nifti.get_data()
+            ## Older nibabel
+
+
+def _affines(nifti, roi, standard=True):
+    """ Return the <nifti> and <roi> affine matrices, q_form
+    if <standard> is True, s_form otherwise. 
+    
+    RoiData has only the one affine, so that is used. If <roi> 
+    is None, so is its affine. """
+    
+    affines = []
+    for img in (nifti, roi):
+        if img is None:
+            affines.append(None)
+        elif isinstance(img, RoiData):
+            affines.append(img.affine)
+        elif standard:
+            affines.append(img.get_header().get_qform())
+        else:
+            affines.append(img.get_header().get_sform())
+    
+    return affines
+
+
+def _roi_index(nifti, roi, standard=True):
+    """ Find the voxels in <nifti> that overlap with <roi> (a binary
+    nibabel object or RoiData), returning a sorted array of flat 
+    (C order) indices into the first 3 (x, y, z) axes of <nifti>. """
+
+    nifti_affine, roi_affine = _affines(nifti, roi, standard)
+
+    return _grid_index(
+            _roi_voxels(roi), roi.shape, roi_affine, 
+            nifti_affine, nifti.shape)
+
+
+def _roi_voxels(roi):
+    """ Find only voxels that are 1 in <roi>, returning their 
+    flat (C order) indices. """
+
+    if isinstance(roi, RoiData):
+        roi_flat_index = roi.index
     else:
-        # When 3d:
-        nifti_data = nifti_data[...,np.newaxis]
-            ## We need to add a empty 4th d
-        n_vol = 1
-            ## so this makes sense.
-    # --
-    # Find only voxels that are 1
-    # in the roi native space
-    # then convert these to standard space
-    roi_mask = roi.get_data().astype('int8') == 1
-    print("{0} voxels in the mask.".format(np.sum(roi_mask)))
-
-    roi_index = _native_index(roi_mask)
-    roi_index_filtered = np.array(
-            [
-                np.array([x, y, z]) for x, y, z in roi_index if 
-                    roi_mask[x, y, z]
-            ])
-
-    roi_std_index = np.array([_affine_xyz(xyz, roi_affine) for 
-            xyz in roi_index_filtered])
-
-    # Convert nifti to standard space too
-    nifti_std_index = _affine_index(nifti_data, nifti_affine)
-   
+        roi_flat_index = np.flatnonzero(_get_data(roi) == 1)
+    print("{0} voxels in the mask.".format(roi_flat_index.shape[0]))
+
+    return roi_flat_index
+
+
+def _grid_index(roi_flat_index, roi_shape, roi_affine, affine, shape):
+    """ Map the roi voxels (<roi_flat_index> into a volume of 
+    <roi_shape> with <roi_affine>) onto the grid of <shape> with 
+    <affine>, returning a sorted array of flat grid indices. 
+    
+    Results are cached (see IndexCache) by roi, affine and shape. """
+
+    key = roi_index_cache.key(
+            roi_flat_index, roi_shape[0:3], roi_affine, affine, shape[0:3])
+    index = roi_index_cache.get(key)
+    if index is not None:
+        return index
+
+    # Convert the roi to standard space 
+    roi_native_index = np.array(
+            np.unravel_index(roi_flat_index, roi_shape[0:3])).transpose()
+    roi_std_index = _affine_coords(roi_native_index, roi_affine)
+
     # --
     # Find neighborhoods where nifti and roi overlap
     # (in standard space).
-    neighborhood = np.abs(np.diag(nifti_affine)[0:3]) - np.abs(np.diag(roi_affine)[0:3])
+    neighborhood = np.abs(np.diag(affine)[0:3]) - np.abs(np.diag(roi_affine)[0:3])
     neighborhood[neighborhood < 1] = 1.0
         ## Any fractions or negative values should be set to zero
         ## as they are within the neighborhood
 
-    # As _search_neighborhood() returns subarays
-    # Needed an efficient way to concat them
-    # row-wise, thus list.extend()
-    matches = [] 
-    [matches.extend(_search_neighborhood(
-            nifti_std_index, xyz, neighborhood)) for xyz in roi_std_index]
-    matches = np.array(matches)
-        ## But in the end we need an array
-
-    inv_nifti_affine = np.linalg.inv(nifti_affine)
-    nifti_index_reduced = np.array([_affine_xyz(xyz, inv_nifti_affine) for 
-            xyz in matches])
-        ## Just invert the affine to get back
-        ## to native space
-
-    # Use n_i_reduced to make a mask...
-    # Starting with zeros at every match 
-    # put in a 1, finally convert to bool.
-    vol_mask = np.zeros(nifti_shape, dtype=np.bool)
-    for x, y, z in nifti_index_reduced:
-        vol_mask[x, y, z] += True
-
-    # -- 
-    # Reduce the data from nifti 
-    nifti_data_reduced = np.zeros(nifti_shape + (n_vol, ), dtype=np.int16)
-    for vol in range(n_vol):
-        nifti_data_reduced[vol_mask,vol] += nifti_data[vol_mask,vol] 
-
-    # -- 
-    # Return a nifti object with
-    # proper meta-data
-    return nb.Nifti1Image(
-            nifti_data_reduced, nifti_affine, nifti.get_header())
+    grid = voxel_grid(affine, shape)
+    index = grid.box(roi_std_index, neighborhood)
+    roi_index_cache[key] = index
+
+    return index
+
+
+def _mask_parallel(nifti, rois, standard, dtype, n_jobs):
+    """ Mask <nifti> with each of <rois> in a pool of <n_jobs> 
+    processes, returning a list of (index, voxels) for each roi,
+    in order.
+    
+    The data is shared with the workers as a (read-only) memory-map, 
+    never pickled.  If <nifti> can't be memory-mapped from its own 
+    file the data is first saved to a temporary one. """
+
+    nifti_affine = _affines(nifti, None, standard)[0]
+    jobs = [(_roi_voxels(roi), roi.shape[0:3], 
+            _affines(None, roi, standard)[1], dtype) for roi in rois]
+
+    tmpdir = None
+    filename = None
+    if not isinstance(nifti, Runs):
+        filename = nifti.get_filename()
+    
+    data = _get_data(nifti)
+        ## Only once, as compressed or scaled 
+        ## data is decoded in full each time
+    if (filename is not None) and isinstance(data, np.memmap):
+        source = ('nifti', filename)
+    else:
+        tmpdir = tempfile.mkdtemp()
+        source = ('npy', os.path.join(tmpdir, 'data.npy'))
+        np.save(source[1], np.asarray(data))
+    del data
+
+    pool = multiprocessing.Pool(
+            n_jobs, _init_mask_worker, 
+            (source, nifti_affine, nifti.shape[0:3], roi_index_cache.path))
+    try:
+        results = pool.map(
+                _mask_worker, jobs, 
+                chunksize=max(1, len(jobs) // (4 * n_jobs)))
+    finally:
+        pool.close()
+        pool.join()
+        if tmpdir is not None:
+            shutil.rmtree(tmpdir)
+
+    return results
+
+
+_WORKER = {}
+
+
+def _init_mask_worker(source, affine, shape, cache_path):
+    """ Open the shared data (see _mask_parallel()) in a worker. """
+    
+    kind, name = source
+    if kind == 'nifti':
+        data = _get_data(nb.load(name))
+    else:
+        data = np.load(name, mmap_mode='r')
+    
+    _WORKER.update({'data' : data, 'affine' : affine, 'shape' : shape})
+    roi_index_cache.path = cache_path
+
+
+def _mask_worker(job):
+    """ Mask the worker's data with one roi. """
+    
+    roi_flat_index, roi_shape, roi_affine, dtype = job
+    index = _grid_index(
+            roi_flat_index, roi_shape, roi_affine, 
+            _WORKER['affine'], _WORKER['shape'])
+
+    voxels = _WORKER['data'][np.unravel_index(index, _WORKER['shape'])]
+    if voxels.ndim == 1:
+        voxels = voxels[:,np.newaxis]
+    if dtype is not None:
+        voxels = voxels.astype(dtype)
+    
+    return index, np.asarray(voxels)
+
+
+class VoxelGrid(object):
+    """ A spatial index over the voxels of a (BOLD) grid of <shape>
+    with <affine>, answering box and radius queries in standard 
+    (i.e. millimeter) space.
+
+    As the grid is regular there is no need to store or scan its
+    coordinates. Each query location is mapped back to native space by
+    the inverse affine, and only a small box of candidate voxels around
+    it is checked.  Use voxel_grid() to get a (cached) instance. """
+
+    def __init__(self, affine, shape):
+        self.affine = np.asarray(affine, dtype=float)
+        self.shape = tuple(shape[0:3])
+        self.inv_affine = np.linalg.inv(self.affine)
+
+    def box(self, locations, neighborhood, chunk=2**20):
+        """ Find voxels whose (rounded) standard space coordinates are 
+        within <neighborhood> (x, y, z distances) of any row of 
+        <locations> (a 2d column oriented array of standard space
+        coordinates).
+        
+        This matches an exhaustive search with _search_neighborhood().
+        
+        Returns a sorted array of flat (C order) voxel indices. """
+
+        neighborhood = np.abs(np.asarray(neighborhood, dtype=float))
+        matches = []
+        for cand, loc in self._candidates(
+                locations, neighborhood + 0.5, chunk):
+            diff = np.abs(_affine_coords(cand, self.affine) - loc)
+            near = np.all(diff <= neighborhood, axis=1)
+            matches.append(np.ravel_multi_index(
+                    cand[near].transpose(), self.shape))
+
+        return self._unique(matches)
+
+    def ball(self, locations, radius, chunk=2**20):
+        """ Find voxels whose (unrounded) standard space coordinates 
+        are within <radius> of any row of <locations>. 
+        
+        Returns a sorted array of flat (C order) voxel indices. """
+        
+        matches = []
+        for cand, loc in self._candidates(
+                locations, np.repeat(float(radius), 3), chunk):
+            dist = _affine_coords(cand, self.affine, rounded=False) - loc
+            near = np.sum(dist ** 2, axis=1) <= radius ** 2
+            matches.append(np.ravel_multi_index(
+                    cand[near].transpose(), self.shape))
+        
+        return self._unique(matches)
+
+    def _candidates(self, locations, reach, chunk):
+        """ Yield (in chunks) candidate voxels and the locations they 
+        are candidates for, given <locations> and the standard space 
+        <reach> (x, y, z) of a query. """
+        
+        locations = np.asarray(locations).reshape(-1, 3)
+        
+        # The reach mapped to native space; the extra 
+        # 0.5 covers rounding the centers.
+        reach = np.abs(self.inv_affine[0:3,0:3]).dot(reach) + 0.5
+        reach = np.ceil(reach).astype(int)
+
+        offsets = np.indices(tuple(2 * reach + 1)).reshape(3, -1).transpose()
+        offsets -= reach
+        
+        centers = _affine_coords(locations, self.inv_affine, rounded=False)
+        centers = np.round(centers).astype(int)
+
+        # Work in chunks of centers so memory 
+        # stays bounded for large ROIs.
+        step = max(1, chunk // offsets.shape[0])
+        for i in range(0, centers.shape[0], step):
+            cand = (centers[i:i+step,np.newaxis,:] + offsets).reshape(-1, 3)
+            loc = np.repeat(locations[i:i+step], offsets.shape[0], axis=0)
+
+            inbounds = np.all((cand >= 0) & (cand < self.shape), axis=1)
+            yield cand[inbounds], loc[inbounds]
+
+    def _unique(self, matches):
+        if len(matches) == 0:
+            return np.array([], dtype=int)
+
+        return np.unique(np.concatenate(matches))
+
+
+_GRIDS = LRUCache(maxsize=16)
+
+
+class IndexCache(object):
+    """ A cache of the voxels each roi covers in a BOLD grid, keyed by 
+    the roi and the grid's affine and shape.  As studies usually share
+    one grid, this is worked out once per study rather than once per
+    subject and roi.
+
+    Results are kept in memory (the <maxsize> most recently used) 
+    and, if <path> (a directory) is not None, on disk as well. 
+    
+    mask() and friends use roi_index_cache, an instance of this. Set 
+    its path to share the cache across processes and runs.
+    """
+
+    def __init__(self, maxsize=1024, path=None):
+        self.path = path
+        self._memory = LRUCache(maxsize=maxsize)
+
+    def key(self, *parts):
+        """ Hash <parts> (arrays or sequences) into a key. """
+
+        sha = hashlib.sha1()
+        for part in parts:
+            part = np.ascontiguousarray(part)
+            sha.update(str(part.dtype).encode())
+            sha.update(str(part.shape).encode())
+            sha.update(part.tobytes())
+
+        return sha.hexdigest()
+
+    def get(self, key):
+        """ Return the index for <key>, or None if it's not cached. """
+
+        index = self._memory.get(key)
+        if (index is None) and (self.path is not None):
+            name = os.path.join(self.path, key + '.npy')
+            if os.path.exists(name):
+                index = np.load(name)
+                self._memory[key] = index
+
+        return index
+
+    def __setitem__(self, key, index):
+        self._memory[key] = index
+
+        if self.path is not None:
+            if not os.path.exists(self.path):
+                os.makedirs(self.path)
+
+            # Write then rename, so other processes
+            # never see a partial file.
+            name = os.path.join(self.path, key + '.npy')
+            tmpname = os.path.join(
+                    self.path, '{0}.{1}.tmp.npy'.format(key, os.getpid()))
+            np.save(tmpname, index)
+            os.rename(tmpname, name)
+
+    def clear(self):
+        """ Empty the in-memory cache (the disk is left alone). """
+
+        self._memory.clear()
+
+
+roi_index_cache = IndexCache()
+
+
+def voxel_grid(affine, shape):
+    """ Return the VoxelGrid for <affine> and <shape>, building it only
+    the first time a grid is asked for. """
+    
+    affine = np.asarray(affine, dtype=float)
+    key = (affine.tobytes(), tuple(shape[0:3]))
+
+    grid = _GRIDS.get(key)
+    if grid is None:
+        grid = VoxelGrid(affine, shape)
+        _GRIDS[key] = grid
+
+    return grid
+
+
+def _affine_coords(index, affine, rounded=True):
+    """ Apply an <affine> transform to every row of <index> (a 2d 
+    column oriented array of x, y, z coordinates) in one matrix 
+    product.
+
+    If <rounded> is True (default) the result is rounded to
+    integers, i.e. nearest neighbor interpolation as in _affine_xyz(). """
+
+    affine = np.asarray(affine)
+    if affine.shape != (4, 4):
+        raise ValueError("affine matrix must be square, of rank 4.")
+    if np.sum(affine[3,:]) != 1:
+        raise ValueError("affine matrix is not in homogenous coordinates")
+
+    index = np.asarray(index).reshape(-1, 3)
+    trans = index.dot(affine[0:3,0:3].transpose()) + affine[0:3,3]
+    if rounded:
+        trans = np.round(trans).astype(int)
+
+    return trans
 
 
 def _search_neighborhood(index, location, neighborhood):
@@ -275,19 +1077,280 @@ def _affine_xyz(xyz, affine):
         ## Dropping homogenous coords
     
 
-# Use index for each to mask.
-#def top_t(nifti, tmap, percent):
-#    pass
+def top_t(roidatas, tmap, percent):
+    """ Select the top <percent> (0-100) of voxels in <roidatas> 
+    (RoiData, or a list of them) by their value in <tmap> (a nibabel 
+    object or array, on the same grid as the rois). 
+    
+    <percent> can also be a list of percents.  Each roi is searched
+    only once, however many percents are asked for.
+
+    Returns the flat indices (see RoiData) of the selected voxels, 
+    highest first. Given a list of rois and/or percents, a list 
+    ([roi][percent]) of these is returned. """
+    
+    if isinstance(tmap, np.ndarray):
+        tdata = tmap
+    else:
+        tdata = _get_data(tmap)
+    if tdata.ndim > 3:
+        tdata = tdata[...,0]
+
+    def score(roidata):
+        if tdata.shape[0:3] != roidata.shape:
+            raise ValueError("tmap and roi are on different grids")
+
+        return tdata[np.unravel_index(roidata.index, roidata.shape)]
+
+    return _select(roidatas, percent, score)
+
+
+def top_var(roidatas, percent):
+    """ Select the top <percent> (0-100) of voxels in <roidatas> 
+    by their variance over time. 
+    
+    See top_t() for the details. """
+    
+    return _select(
+            roidatas, percent, lambda roidata: roidata.data.var(axis=1))
+
+
+def top_info(roidatas, percent, bins=10):
+    """ Select the top <percent> (0-100) of voxels in <roidatas> 
+    by the information (Shannon entropy, in bits) in their timecourse, 
+    binned into <bins> equal width bins.
+    
+    See top_t() for the details. """
+
+    return _select(
+            roidatas, percent, lambda roidata: _entropy(roidata.data, bins))
+
+
+def _select(roidatas, percents, score):
+    """ Select the top <percents> of each of <roidatas> by <score>, 
+    a function returning a value for every voxel in a RoiData (see
+    top_t()). """
+    
+    one_roi = isinstance(roidatas, RoiData)
+    if one_roi:
+        roidatas = [roidatas, ]
+
+    one_percent = np.ndim(percents) == 0
+    percents = np.atleast_1d(np.asarray(percents, dtype=float))
+    if np.any(percents < 0) or np.any(percents > 100):
+        raise ValueError("percent must be between 0-100")
+    
+    # Partial sort enough for the largest percent,
+    # then take the rest from that.
+    selected = []
+    for roidata in roidatas:
+        ks = np.ceil(len(roidata) * percents / 100.0).astype(int)
+        top = roidata.index[_top_k(score(roidata), ks.max())]
+        selected.append([top[0:k] for k in ks])
+    
+    if one_percent:
+        selected = [sel[0] for sel in selected]
+    if one_roi:
+        selected = selected[0]
+
+    return selected
+
+
+def _entropy(data, bins):
+    """ The Shannon entropy (bits) of each row of <data> (2d), 
+    binned into <bins> equal width bins. """
+
+    n_row, n_col = data.shape
+    if n_row == 0:
+        return np.array([])
+
+    low = data.min(axis=1)[:,np.newaxis]
+    span = data.max(axis=1)[:,np.newaxis] - low
+    span[span == 0] = 1.0
+
+    codes = np.floor((data - low) / span * bins).astype(int)
+    codes = np.minimum(codes, bins - 1)
+    
+    # Count codes for every row at once
+    flat = (np.arange(n_row)[:,np.newaxis] * bins + codes).ravel()
+    counts = np.bincount(flat, minlength=n_row * bins).reshape(n_row, bins)
+
+    prob = counts / float(n_col)
+    logprob = np.zeros_like(prob)
+    logprob[prob > 0] = np.log2(prob[prob > 0])
+
+    return -np.sum(prob * logprob, axis=1)
+
+
+def pca(nifti, num, roi=None, chunk=64, n_iter=2, prng=None):
+    """ Reduce the voxel timecourses in <nifti> to <num> component 
+    timecourses by (randomized) PCA.
+
+    Parameters
+    ----------
+    nifti : RoiData, nibabel object or Runs
+        The data.  For nibabel objects and Runs the voxels used are
+        those in <roi> or, if <roi> is None, those active 
+        (see num_active_voxels()) in the first volume.
+    num : int
+        The number of components
+    roi : nibabel object, RoiData or None
+        An (optional) roi (see mask())
+    chunk : int
+        The number of volumes to read at a time
+    n_iter : int
+        The number of power iterations; more improves accuracy
+        when the singular values decay slowly
+    prng : np.random.RandomState, None
+        A RandomState instance, or None
+
+    Returns the component timecourses (n_vols, num), and prng.
+
+    Note
+    ----
+    The data is streamed in chunks of volumes, so only a few 
+    (n_voxels, num + 10) arrays are ever held in memory, never
+    the full (n_voxels, n_vols) data.  Each pass over the data 
+    reads it once; there are n_iter + 2 passes.
+    
+    Halko N, et al, Finding Structure with Randomness: Probabilistic 
+    Algorithms for Constructing Approximate Matrix Decompositions, 
+    SIAM Review, 53, 217-288 (2011).
+    """
+
+    prng = process_prng(prng)
+    
+    chunks = _VolumeChunks(nifti, roi, chunk)
+    n_vol = chunks.n_vol
+    n_sample = min(num + 10, n_vol)
+
+    # Sample the range of the data, while 
+    # getting the mean of each voxel
+    omega = prng.normal(size=(n_vol, n_sample))
+    sample = 0.0
+    total = 0.0
+    for start, stop, data in chunks:
+        sample = sample + data.dot(omega[start:stop])
+        total = total + data.sum(axis=1)
+    mean = total / n_vol
+    sample -= np.outer(mean, omega.sum(axis=0))
+    
+    # Power iterations, using the centered data
+    for _ in range(n_iter):
+        basis = np.linalg.qr(sample)[0]
+        sample = 0.0
+        for start, stop, data in chunks:
+            data = data - mean[:,np.newaxis]
+            sample = sample + data.dot(data.transpose().dot(basis))
+
+    # Project onto the sampled range, and 
+    # decompose that (small) matrix.
+    basis = np.linalg.qr(sample)[0]
+    projected = np.zeros((basis.shape[1], n_vol))
+    for start, stop, data in chunks:
+        projected[:,start:stop] = basis.transpose().dot(
+                data - mean[:,np.newaxis])
+    
+    vt = np.linalg.svd(projected, full_matrices=False)[2]
+    timecourses = vt[0:num].transpose()
+    
+    # Fix the sign, so the largest value is positive
+    peaks = timecourses[
+            np.argmax(np.abs(timecourses), axis=0), np.arange(num)]
+    timecourses *= np.sign(peaks)
+
+    return timecourses, prng
 
-#def top_var(nifti, percent):
-#    pass
 
-#def top_info(nifti, percent):
-#    pass
+def ica(nifti, num, roi=None, chunk=64, max_iter=200, tol=1e-4, prng=None):
+    """ Reduce the voxel timecourses in <nifti> to <num> independent 
+    component timecourses.
+    
+    The data are first reduced (and whitened) by pca() (see that for
+    <nifti>, <roi> and <chunk>), then (temporal) ICA is run on the 
+    <num> pca timecourses using FastICA (log cosh) with symmetric 
+    decorrelation, for up to <max_iter> iterations or until the 
+    change is less than <tol>.
+
+    Returns the component timecourses (n_vols, num), and prng.
+
+    Hyvarinen A, Fast and Robust Fixed-Point Algorithms for Independent
+    Component Analysis, IEEE Trans. on Neural Networks, 10, 626-634 
+    (1999).
+    """
+
+    timecourses, prng = pca(nifti, num, roi=roi, chunk=chunk, prng=prng)
+    
+    # pca timecourses are orthonormal, 
+    # so rescaling makes them white.
+    n_vol = timecourses.shape[0]
+    white = timecourses.transpose() * np.sqrt(n_vol)
+
+    unmix = _decorrelate(prng.normal(size=(num, num)))
+    for _ in range(max_iter):
+        gwx = np.tanh(unmix.dot(white))
+        g_wx = 1 - gwx ** 2
+        
+        new_unmix = _decorrelate(
+                gwx.dot(white.transpose()) / n_vol - 
+                g_wx.mean(axis=1)[:,np.newaxis] * unmix)
+        
+        change = np.max(np.abs(np.abs(np.diag(new_unmix.dot(
+                unmix.transpose()))) - 1))
+        unmix = new_unmix
+        if change < tol:
+            break
+
+    return unmix.dot(white).transpose(), prng
 
-#def pca(nifti, num):
-#    pass
 
-#def ica(nifti, num):
-#    pass
+def _decorrelate(unmix):
+    """ Symmetric decorrelation, W <- (W W^T)^(-1/2) W """
+
+    values, vectors = np.linalg.eigh(unmix.dot(unmix.transpose()))
+    
+    return vectors.dot(
+            np.diag(1.0 / np.sqrt(values))).dot(vectors.transpose()).dot(unmix)
+
+
+class _VolumeChunks(object):
+    """ Iterate over the data in <nifti> (see pca()) in chunks of 
+    <chunk> volumes, yielding (start, stop, data) where data is an 
+    (n_voxels, stop - start) array. 
+    
+    Each chunk is read on its own (by slicing the nibabel array 
+    proxy), so only one chunk is ever in memory, even for 
+    compressed or scaled files. """
+
+    def __init__(self, nifti, roi, chunk):
+        self.nifti = nifti
+        self.chunk = chunk
+
+        if isinstance(nifti, RoiData):
+            self.n_vol = nifti.n_vol
+            return
+        
+        self.n_vol = nifti.shape[3] if len(nifti.shape) > 3 else 1
+        self.dataobj = getattr(nifti, 'dataobj', None)
+        if (self.dataobj is None) or (len(nifti.shape) == 3):
+            self.dataobj = _get_data(nifti)
+                ## Older nibabel, or a single vol
+            if self.dataobj.ndim == 3:
+                self.dataobj = self.dataobj[...,np.newaxis]
+
+        if roi is None:
+            index = np.flatnonzero(np.asarray(self.dataobj[...,0]) > 0.01)
+        else:
+            index = _roi_index(nifti, roi)
+        self.ijk = np.unravel_index(index, nifti.shape[0:3])
 
+    def __iter__(self):
+        for start in range(0, self.n_vol, self.chunk):
+            stop = min(start + self.chunk, self.n_vol)
+            
+            if isinstance(self.nifti, RoiData):
+                data = self.nifti.data[:,start:stop]
+            else:
+                data = np.asarray(self.dataobj[...,start:stop])[self.ijk]
+            
+            yield start, stop, np.asarray(data, dtype=float)
@@ -1,5 +1,6 @@
 """ A module process trial timing information. """
 import numpy as np
+from modelmodel.dm import convolve_hrf
 
 
 def dtime(arr, durations, drop=None, drop_value=0):
@@ -25,30 +26,38 @@ def dtime(arr, durations, drop=None, drop_value=0):
     Note: If duration for that trial is less than the length
     of drop, the rightside excess entries of drop are ignored.
 
-    Returns a list of the duration mapped trials. """
+    <arr> can be 2d, in which case whole rows (e.g. of a design 
+    matrix) are repeated, and dropped.
+
+    Returns an array of the duration mapped trials. """
     
-    trials = arr
-    dtrials = []
-
-    if drop == None:
-        # Using tuple math, repeat trial by dur
-        # adding flattly to dtrials.
-        [dtrials.extend([trial, ] * dur) for trial, dur in zip(
-            trials, durations)]
-    else:
-        # As above but dropping trial entries       
-        mask = np.array(drop) == 1
-            ## Convert drop to a bool mask
+    # Like zip(), ignore any excess arr 
+    # or durations.
+    durations = np.asarray(durations, dtype=int)
+    arr = np.asarray(arr)
+    n = min(arr.shape[0], durations.shape[0])
+    durations = durations[0:n]
     
-        for trial, dur in zip(trials, durations):
-            dtrial = np.array([trial, ] * dur)
-            dtrial[mask[0:dur]] = drop_value
-                ## Apply mask
-                ## drop rightside excess entries in drop as dur 
+    dtrials = np.repeat(arr[0:n], durations, axis=0)
+    if (drop is None) or (dtrials.shape[0] == 0):
+        return dtrials
+
+    # Find each entry's position within its trial,
+    # and drop by position using a mask as long as
+    # the longest trial.
+    starts = np.cumsum(durations) - durations
+    position = np.arange(dtrials.shape[0]) - np.repeat(starts, durations)
 
-            dtrials.extend(dtrial.tolist())
+    mask = np.array(drop) == 1
+        ## Convert drop to a bool mask
+    tiled = np.zeros(max(durations.max(), mask.shape[0]), dtype=bool)
+    tiled[0:mask.shape[0]] = mask
+        ## Entries in drop past a trial's 
+        ## duration are never reached
 
-    return np.array(dtrials)
+    dtrials[tiled[position]] = drop_value
+
+    return dtrials
 
 
 def add_empty(data, conditions):
@@ -59,26 +68,108 @@ def add_empty(data, conditions):
     <conditions> shouls be an integer sequence of trial events.
         '0' indicates a jitter period.  In implictly assumes 
         jitter and trial lengths are the same.
-    <data> should be a list. """
-    from copy import deepcopy
+    <data> should be a list or array (numeric or strings). If 
+        2d, whole rows are placed, and zero-filled. 
+    
+    Returns a list if <data> was a list, otherwise an array. """
 
-    # Reverse for pop.
-    rdata = deepcopy(data)
-    rdata.reverse()
+    arr = np.asarray(data)
+    
+    # Find the jitter periods
+    conds = np.asarray(conditions)
+    if conds.dtype.kind in ('S', 'U'):
+        jitter = conds == '0'
+    elif conds.dtype.kind == 'O':
+        jitter = np.array([(cond == 0) or (cond == '0') for cond in conds])
+    else:
+        jitter = conds == 0
+    
+    n_trial = np.sum(~jitter)
+    if arr.shape[0] < n_trial:
+        raise IndexError("there are more trials than data")
 
     # Assume we want to fill with zeros
     # but change to strings if data
     # is a list of strings.
     empty = 0
-    if hasattr(data[0], 'capitalize'):
-        ## a standard string-like method   
+    if arr.dtype.kind in ('S', 'U'):
         empty = '0'
+    
+    # Scatter the data into place.
+    data_w_empty = np.empty((conds.shape[0], ) + arr.shape[1:], 
+            dtype=arr.dtype)
+    data_w_empty[jitter] = empty
+    data_w_empty[~jitter] = arr[0:n_trial]
 
-    data_w_empty = []
-    for cond in conditions:
-        if (cond == 0) or (cond == '0'):
-            data_w_empty.append(empty)
-        else:
-            data_w_empty.append(rdata.pop())
+    if isinstance(data, list):
+        return data_w_empty.tolist()
 
     return data_w_empty
+
+
+def events(onsets, durations, amplitudes, conditions, TR, n_tr, 
+        oversample=16, hrf=None):
+    """ Build a (n_tr, n_cond) stimulus matrix, one column per 
+    condition, from a table of events.
+
+    Parameters
+    ----------
+    onsets : array-like
+        Event onsets (seconds)
+    durations : array-like
+        Event durations (seconds); events shorter than one 
+        oversampled bin become impulses
+    amplitudes : array-like
+        Event amplitudes (e.g. parametric values)
+    conditions : array-like
+        Event condition codes (ints or strs)
+    TR : float
+        The repetition time (seconds)
+    n_tr : int
+        The number of TRs
+    oversample : int
+        The number of bins per TR used to place the events
+    hrf : array-like, None
+        If not None, an HRF (sampled at TR / oversample) to convolve
+        the columns with before downsampling.
+
+    Returns the stimulus matrix and the conditions (in column order).
+
+    Note
+    ----
+    Every event is placed at once by adding its amplitude where it 
+    starts and subtracting it where it stops, on the oversampled 
+    time grid; a cumulative sum then fills in each event.  Each TR
+    is the mean of its bins.
+    """
+
+    onsets = np.asarray(onsets, dtype=float)
+    durations = np.asarray(durations, dtype=float)
+    amplitudes = np.asarray(amplitudes, dtype=float)
+    names, cols = np.unique(np.asarray(conditions), return_inverse=True)
+    
+    if not (onsets.shape == durations.shape == amplitudes.shape 
+            == cols.shape):
+        raise ValueError("onsets, durations, amplitudes and conditions "
+                "must have the same length")
+
+    # Convert to bins of the oversampled
+    # grid, dropping events past the end.
+    n_bin = n_tr * oversample
+    dt = float(TR) / oversample
+    starts = np.round(onsets / dt).astype(int)
+    stops = np.round((onsets + durations) / dt).astype(int)
+    stops = np.maximum(stops, starts + 1)
+    stops = np.minimum(stops, n_bin)
+    
+    keep = (starts >= 0) & (starts < n_bin)
+    
+    edges = np.zeros((n_bin + 1, names.shape[0]))
+    np.add.at(edges, (starts[keep], cols[keep]), amplitudes[keep])
+    np.add.at(edges, (stops[keep], cols[keep]), -amplitudes[keep])
+    stim = np.cumsum(edges, axis=0)[0:n_bin]
+
+    if hrf is not None:
+        stim = convolve_hrf(stim, hrf)
+
+    return stim.reshape(n_tr, oversample, -1).mean(axis=1), names
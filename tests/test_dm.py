@@ -42,6 +42,65 @@ def test_convolve_hrf():
             "2d cols (0,1) malfunction")
 
 
+def test_convolve_hrf_batch():
+    prng = np.random.RandomState(42)
+    dg = hrf.double_gamma(width=32, TR=1)
+    
+    # A stack of dms matches each dm convolved alone
+    dms = prng.normal(size=(4, 100, 3))
+    convolved = dm.convolve_hrf(dms, dg)
+    assert convolved.shape == dms.shape, "Stack shape changed"
+    for dm1, con in zip(dms, convolved):
+        expected = np.vstack(
+                [np.convolve(col, dg)[0:100] for col in dm1.T]).T
+        assert np.allclose(con, expected), "Stack convolve malfunction"
+    
+    # FFT (long hrf) and direct (short hrf)
+    # both match np.convolve
+    for hrf1 in [prng.normal(size=200), dg[0:5]]:
+        expected = np.convolve(dms[0,:,0], hrf1)[0:100]
+        assert np.allclose(dm.convolve_hrf(dms[0,:,0], hrf1), expected)
+    
+    # DataFrames keep all cols
+    df = pd.DataFrame(dms[0], columns=['a', 'b', 'c'])
+    condf = dm.convolve_hrf(df, dg, ['b'])
+    assert np.allclose(condf['a'], df['a']), "Unselected col changed"
+    assert np.allclose(condf['b'], convolved[0,:,1]), "DataFrame malfunction"
+
+
+def test_convolve_hrf_groups():
+    dg = hrf.double_gamma(width=32, TR=1)
+    
+    # Two runs, joined
+    dm1 = np.zeros([40, 2])
+    dm1[0,:] = 1
+    dm1[35,:] = 1
+    groups = np.repeat([0, 1], [30, 10])
+    
+    # Run 1's HRF tail does not reach into run 2
+    convolved = dm.convolve_hrf(dm1, dg, groups=groups)
+    assert np.allclose(convolved[0:30,0], dg[0:30]), "Run 1 malfunction"
+    assert np.allclose(convolved[30:40,0], 
+            np.convolve(dm1[30:40,0], dg)[0:10]), "Run 2 malfunction"
+    
+    # Groups by col name
+    df = pd.DataFrame(dm1, columns=['a', 'b'])
+    df['count'] = groups
+    condf = dm.convolve_hrf(df, dg, ['a'], groups='count')
+    assert np.allclose(condf['a'], convolved[:,0]), "DataFrame malfunction"
+
+
+def test_hrf_cache():
+    dg = hrf.double_gamma(width=32, TR=1)
+    assert dg is hrf.double_gamma(width=32, TR=1), "Kernel not cached"
+    assert hrf.double_gamma(width=32, TR=1, oversample=2).shape[0] == 64, (
+            "Oversample malfunction")
+    
+    freq = hrf.kernel_fft(dg, 128)
+    assert freq is hrf.kernel_fft(dg.copy(), 128), "FFT not cached"
+    assert np.allclose(freq, np.fft.rfft(dg, 128)), "FFT malfunction"
+
+
 def test_orthogonalize():
     # --
     # np
@@ -63,5 +122,39 @@ def test_orthogonalize():
     dmo = dm.orthogonalize(dm1, ['0','1'])
     assert np.allclose(dmo['0'].values, dm1['0'].values)
     assert np.allclose(dmo['1'].values, np.zeros_like(dmo['1'].values))
+    dmo = dm.orthogonalize(dm1, ['0','1'], chain=True)
+    assert np.allclose(dmo['1'].values, np.zeros_like(dmo['1'].values))
+
+    # -------------------
+    # pairs, chains, stacks
+    # -------------------
+    prng = np.random.RandomState(42)
+    dm3 = prng.normal(size=(4, 20, 3))
+    
+    # Regression residuals
+    dmo = dm.orthogonalize(dm3[0], [0, 1, 2])
+    for left, right in [(0, 1), (1, 2)]:
+        beta = np.linalg.lstsq(dm3[0][:,[left]], dm3[0][:,right])[0]
+        assert np.allclose(dmo[:,right], 
+                dm3[0][:,right] - dm3[0][:,left] * beta), "Residual malfunction"
+    
+    # Pairs
+    dmo = dm.orthogonalize(dm3[0], [[0, 1], [0, 2]])
+    assert np.allclose(np.dot(dmo[:,0], dmo[:,1:]), 0), "Pairs malfunction"
+    
+    # Chained, so all orthogonal
+    dmo = dm.orthogonalize(dm3[0], [0, 1, 2], chain=True)
+    assert np.allclose(dmo[:,0], dm3[0][:,0]), "Chain malfunction"
+    cov = np.dot(dmo.T, dmo)
+    assert np.allclose(cov, np.diag(np.diag(cov))), "Chain malfunction"
+    
+    # Stacks
+    dmo = dm.orthogonalize(dm3, [0, 1, 2])
+    assert np.allclose(dmo[1], dm.orthogonalize(dm3[1], [0, 1, 2])), (
+            "Stack malfunction")
+    dmo = dm.orthogonalize(dm3, [0, 1, 2], chain=True)
+    for d, dmd in zip(dmo, dm3):
+        q, r = np.linalg.qr(dmd)
+        assert np.allclose(d, q * np.diag(r)), "Stacked chain malfunction"
     
     
\ No newline at end of file
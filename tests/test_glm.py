@@ -0,0 +1,133 @@
+import numpy as np
+import pandas as pd
+import statsmodels.formula.api as smf
+from modelmodel import glm
+
+
+def test_ols():
+    prng = np.random.RandomState(42)
+    df = pd.DataFrame({'a' : prng.normal(size=50), 'b' : prng.normal(size=50)})
+    bolds = np.vstack([df['a'] + prng.normal(size=50), 
+            df['b'] + prng.normal(size=50)]).transpose()
+    
+    glmo = glm.ols_model('bold ~ a + b', df, bolds)
+    assert glmo['beta'].shape == (3, 2), "Batch malfunction"
+
+    for k in range(bolds.shape[1]):
+        df['bold'] = bolds[:,k]
+        smo = smf.ols('bold ~ a + b', data=df).fit()
+        res = glm.column(glmo, k)
+        
+        assert np.allclose(res['beta'], smo.params), "beta malfunction"
+        assert np.allclose(res['t'], smo.tvalues), "t malfunction"
+        assert np.allclose(res['p'], smo.pvalues), "p malfunction"
+        assert np.allclose(res['ci'], smo.conf_int()), "ci malfunction"
+        for key, attr in [('fvalue', 'fvalue'), ('f_pvalue', 'f_pvalue'), 
+                ('r', 'rsquared'), ('r_adj', 'rsquared_adj'), 
+                ('aic', 'aic'), ('bic', 'bic'), ('llf', 'llf'),
+                ('mse_resid', 'mse_resid'), ('mse_model', 'mse_model')]:
+            assert np.allclose(res[key], getattr(smo, attr)), (
+                    "{0} malfunction".format(key))
+    
+        # Tests
+        tres = glm.column(glm.t_test(glmo, 'a - b'), k)
+        stt = smo.t_test('a - b')
+        assert np.allclose(tres['tvalue'], stt.tvalue), "t_test malfunction"
+        assert np.allclose(tres['pvalue'], stt.pvalue), "t_test malfunction"
+        
+        fres = glm.column(glm.f_test(glmo, 'a = 0, b = 0'), k)
+        stf = smo.f_test('a = 0, b = 0')
+        assert np.allclose(fres['fvalue'], stf.fvalue), "f_test malfunction"
+        assert np.allclose(fres['pvalue'], stf.pvalue), "f_test malfunction"
+
+
+def test_design():
+    prng = np.random.RandomState(42)
+    df = pd.DataFrame({'a' : prng.normal(size=20), 'b' : prng.normal(size=20)})
+    
+    bold, X = glm.design('bold ~ a + b', df)
+    assert bold == 'bold', "Name malfunction"
+    assert glm.design('bold ~ a + b', df)[1] is X, "Design not cached"
+    
+    # New data, same DesignInfo
+    df['a'] = prng.normal(size=20)
+    X2 = glm.design('bold ~ a + b', df)[1]
+    assert np.allclose(X2[:,1], df['a']), "New data malfunction"
+    assert X2.design_info is X.design_info, "DesignInfo not reused"
+    
+    # Variables from outside data are not cached
+    w = prng.normal(size=20)
+    Xw = glm.design('bold ~ a + w', df)[1]
+    w = w + 1
+    Xw2 = glm.design('bold ~ a + w', df)[1]
+    assert np.allclose(Xw2[:,2], w), "Stale namespace variable"
+    
+    # Stateful transforms are rebuilt for new data
+    Xs = glm.design('bold ~ center(a)', df)[1]
+    df['a'] = df['a'] + 10
+    Xs2 = glm.design('bold ~ center(a)', df)[1]
+    assert np.allclose(Xs2[:,1], Xs[:,1]), "Stateful transform malfunction"
+
+
+def test_ar1():
+    import statsmodels.api as sm
+    from modelmodel.noise import ar1
+    prng = np.random.RandomState(42)
+    
+    n = 100
+    X = np.vstack([np.ones(n), prng.normal(size=n)]).transpose()
+    bolds = []
+    for k in range(6):
+        noi, prng = ar1(n, alpha=0.5, prng=prng)
+        bolds.append(X[:,1] + np.asarray(noi))
+    bolds = np.vstack(bolds).transpose()
+    
+    # One pooled rho
+    glmo = glm.ar1(X, bolds, names=['Intercept', 'a'], resid=True)
+    assert np.allclose(glmo['rho'], glmo['rho'][0]), "Pooling malfunction"
+    assert glmo['normalized_cov'].shape == (2, 2, 1), "Pooling malfunction"
+    assert glmo['rho'][0] > 0, "rho malfunction"
+    
+    # Binned rhos, checked against statsmodels
+    glmo = glm.ar1(X, bolds, names=['Intercept', 'a'], bins=3)
+    for k in range(bolds.shape[1]):
+        rho = glmo['rho'][k]
+        sigma = rho ** np.abs(np.subtract.outer(np.arange(n), np.arange(n)))
+        smo = sm.GLS(bolds[:,k], X, sigma=sigma).fit()
+        res = glm.column(glmo, k)
+        
+        assert np.allclose(res['beta'], smo.params), "beta malfunction"
+        assert np.allclose(res['t'], smo.tvalues), "t malfunction"
+        assert np.allclose(res['fvalue'], smo.fvalue), "F malfunction"
+        assert np.allclose(res['r'], smo.rsquared), "r malfunction"
+        assert np.allclose(res['llf'], smo.llf), "llf malfunction"
+        assert np.allclose(res['aic'], smo.aic), "aic malfunction"
+        assert np.allclose(res['bic'], smo.bic), "bic malfunction"
+        
+        tres = glm.column(glm.t_test(glmo, 'a'), k)
+        assert np.allclose(tres['tvalue'], smo.tvalues[1]), "t_test malfunction"
+        fres = glm.column(glm.f_test(glmo, 'a = 0'), k)
+        assert np.allclose(fres['fvalue'], smo.tvalues[1] ** 2), (
+                "f_test malfunction")
+
+
+def test_ols_model_scale():
+    prng = np.random.RandomState(42)
+    df = pd.DataFrame({'box' : prng.normal(size=50)})
+    bolds = np.vstack([100 + 5 * df['box'] + prng.normal(size=50), 
+            10 * prng.normal(size=50)]).transpose()
+    
+    model = 'scale(bold) ~ scale(box)'
+    glmo = glm.ols_model(model, df, bolds)
+    for k in range(bolds.shape[1]):
+        df['bold'] = bolds[:,k]
+        smo = smf.ols(model, data=df).fit()
+        res = glm.column(glmo, k)
+        for key, attr in [('beta', 'params'), ('t', 'tvalues'), 
+                ('llf', 'llf'), ('aic', 'aic'), ('bic', 'bic')]:
+            assert np.allclose(res[key], getattr(smo, attr)), (
+                    "{0} malfunction".format(key))
+        
+        # Left side from data
+        res = glm.ols_model(model, df)
+        assert np.allclose(res['beta'], smo.params), "Data malfunction"
@@ -0,0 +1,563 @@
+import numpy as np
+import nibabel as nb
+from modelmodel.roi import pre
+
+
+def _bold_roi():
+    # A 2mm 4d BOLD grid and a 1mm ROI
+    # sharing the same origin
+    bold_affine = np.diag([2., 2., 2., 1.])
+    bold_affine[0:3,3] = [-10, -12, -8]
+    bold = nb.Nifti1Image(
+            np.arange(10 * 12 * 8 * 3, dtype=np.int16).reshape((10, 12, 8, 3)), 
+            bold_affine)
+    bold.get_header().set_qform(bold_affine)
+
+    roi_affine = np.diag([1., 1., 1., 1.])
+    roi_affine[0:3,3] = [-10, -12, -8]
+    roi_data = np.zeros((20, 24, 16), dtype=np.uint8)
+    roi_data[4:7, 5:9, 2:4] = 1
+    roi = nb.Nifti1Image(roi_data, roi_affine)
+    roi.get_header().set_qform(roi_affine)
+
+    return bold, roi
+
+
+def test_voxel_grid_box():
+    bold, roi = _bold_roi()
+    bold_affine = bold.get_header().get_qform()
+    roi_affine = roi.get_header().get_qform()
+    
+    roi_std = pre._affine_coords(
+            np.argwhere(roi.get_data() == 1), roi_affine)
+    neighborhood = np.ones(3)
+    
+    # Exhaustive search over the whole grid
+    std_index = pre._affine_index(bold.get_data()[...,0], bold_affine)
+    matches = []
+    for xyz in roi_std:
+        matches.extend(pre._search_neighborhood(std_index, xyz, neighborhood))
+    inv_affine = np.linalg.inv(bold_affine)
+    native = np.array([pre._affine_xyz(xyz, inv_affine) for xyz in matches])
+    expected = np.unique(np.ravel_multi_index(native.T, bold.shape[0:3]))
+    
+    grid = pre.voxel_grid(bold_affine, bold.shape)
+    found = grid.box(roi_std, neighborhood)
+    assert np.array_equal(found, expected), "box differs from search"
+    
+    # The grid is built once and reused
+    assert pre.voxel_grid(bold_affine, bold.shape) is grid, "grid rebuilt"
+
+
+def test_voxel_grid_ball():
+    affine = np.diag([2., 2., 2., 1.])
+    affine[0:3,3] = [-10, -12, -8]
+    grid = pre.voxel_grid(affine, (10, 12, 8))
+    
+    location = np.array([[0., 0., 0.]])
+    found = grid.ball(location, 4.5)
+    
+    # Check against every voxel's distance
+    coords = pre._affine_coords(
+            pre._native_index(np.zeros(grid.shape)), affine, rounded=False)
+    dist = np.sqrt(np.sum((coords - location) ** 2, axis=1))
+    assert np.array_equal(found, np.where(dist <= 4.5)[0]), "ball is off"
+
+
+def test_affine_coords():
+    affine = np.diag([2., 2., 2., 1.])
+    affine[0:3,3] = [-10, -12, -8]
+    index = pre._native_index(np.zeros((3, 4, 5)))
+    
+    coords = pre._affine_coords(index, affine)
+    for xyz, std in zip(index, coords):
+        assert np.allclose(pre._affine_xyz(xyz, affine), std)
+
+
+def test_mask():
+    bold, roi = _bold_roi()
+    masked = pre.mask(bold, roi)
+    masked_data = masked.get_data()
+    
+    assert masked.shape == bold.shape, "shape changed"
+    
+    # Everything kept matches the orginal,
+    # everything else is zero
+    kept = masked_data[...,0] != 0
+    assert np.sum(kept) > 0, "Nothing kept"
+    assert np.allclose(masked_data[kept], bold.get_data()[kept])
+    assert np.allclose(masked_data[~kept], 0)
+
+
+def test_mask_many():
+    bold, roi = _bold_roi()
+    roi2_data = np.zeros(roi.shape, dtype=np.uint8)
+    roi2_data[10:12, 3:5, 8:12] = 1
+    roi2 = nb.Nifti1Image(roi2_data, roi.get_affine())
+    roi2.get_header().set_qform(roi.get_affine())
+    
+    masked = pre.mask_many(bold, [roi, roi2])
+    assert len(masked) == 2, "Wrong number of rois"
+    
+    # Each should match mask() 
+    for roidata, r in zip(masked, [roi, roi2]):
+        vol = pre.mask(bold, r).get_data()
+        kept = vol[...,0] != 0
+        assert roidata.data.shape == (np.sum(kept), bold.shape[3]), (
+                "Wrong shape")
+        assert np.allclose(roidata.data, vol[kept]), (
+                "Data doesn't match mask()")
+    
+    # Means
+    means = pre.mask_many(bold, [roi, roi2], mean=True)
+    assert means.shape == (2, bold.shape[3]), "Wrong mean shape"
+    assert np.allclose(means[0], masked[0].data.mean(axis=0)), "Bad mean"
+
+
+def test_roidata():
+    bold, roi = _bold_roi()
+    roidata = pre.extract(bold, roi)
+    
+    # Compact, but converts back to
+    # the same nifti as mask()
+    assert roidata.data.shape == (len(roidata), bold.shape[3])
+    assert np.allclose(
+            roidata.to_nifti().get_data(), pre.mask(bold, roi).get_data())
+    assert pre.num_active_voxels(roidata) == pre.num_active_voxels(
+            pre.mask(bold, roi)), "num_active_voxels differs"
+    
+    # RoiData works as a roi too
+    roimask = pre.RoiData(
+            np.flatnonzero(roi.get_data()), roi.get_affine(), roi.shape)
+    assert np.array_equal(pre.extract(bold, roimask).index, roidata.index)
+
+
+def test_mask_dtype():
+    bold, roi = _bold_roi()
+    bold_float = nb.Nifti1Image(
+            bold.get_data().astype(np.float32) / 7.0, bold.get_affine(), 
+            bold.get_header())
+    bold_float.set_data_dtype(np.float32)
+    
+    # Native dtype is kept, without truncation 
+    roidata = pre.extract(bold_float, roi)
+    assert roidata.data.dtype == np.float32, "dtype changed"
+    assert not np.allclose(roidata.data, np.round(roidata.data))
+    
+    # unless asked for
+    masked = pre.mask(bold_float, roi, dtype='int16')
+    assert masked.get_data().dtype == np.int16, "dtype not set"
+    assert masked.get_data_dtype() == np.int16, "header dtype not set"
+
+
+def test_combine4d():
+    bold, _ = _bold_roi()
+    run3d = nb.Nifti1Image(bold.get_data()[...,0], bold.get_affine())
+    
+    combined = pre.combine4d([bold, run3d, bold])
+    assert combined.shape == bold.shape[0:3] + (7, ), "Wrong shape"
+    
+    data = combined.get_data()
+    assert np.allclose(data[...,0:3], bold.get_data())
+    assert np.allclose(data[...,3], bold.get_data()[...,0])
+    assert np.allclose(data[...,4:7], bold.get_data())
+    
+    joined = pre.join_time(bold, bold)
+    assert np.allclose(joined.get_data(), data[...,[0,1,2,4,5,6]])
+    
+    # Memory-mapped, to a file
+    import os
+    import shutil
+    import tempfile
+    tmpdir = tempfile.mkdtemp()
+    try:
+        filename = os.path.join(tmpdir, 'combined.nii')
+        mapped = pre.combine4d([bold, run3d, bold], filename)
+        assert np.allclose(mapped.get_data(), data), "Memmap malfunction"
+        assert np.allclose(nb.load(filename).get_data(), data)
+        
+        # from .hdr/.img pairs too
+        pair = os.path.join(tmpdir, 'bold.img')
+        nb.save(nb.Nifti1Pair(bold.get_data(), bold.get_affine()), pair)
+        filename = os.path.join(tmpdir, 'paired.nii')
+        mapped = pre.combine4d([nb.load(pair), bold], filename)
+        assert np.allclose(nb.load(filename).get_data(), 
+                data[...,[0,1,2,4,5,6]]), "Pair malfunction"
+        
+        for bad in ['combined.nii.gz', 'combined.img']:
+            try:
+                pre.combine4d([bold, bold], os.path.join(tmpdir, bad))
+            except ValueError:
+                pass
+            else:
+                raise AssertionError("{0} not rejected".format(bad))
+            assert not os.path.exists(os.path.join(tmpdir, bad))
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def test_runs():
+    bold, roi = _bold_roi()
+    runs = pre.Runs([bold, bold])
+    combined = pre.combine4d([bold, bold])
+    data = combined.get_data()
+    
+    assert runs.shape == combined.shape, "Wrong shape"
+    
+    # Indexing matches the combined data
+    assert np.allclose(runs[...], data)
+    assert np.allclose(runs[...,4], data[...,4])
+    assert np.allclose(runs[1:3,2:5,...,[5,0,3]], data[1:3,2:5,...,[5,0,3]])
+    assert np.allclose(runs[1,2:5,3,4], data[1,2:5,3,4])
+    assert np.allclose(runs[[0,1],[2,3],[4,5]], data[[0,1],[2,3],[4,5]])
+    assert np.allclose(runs[-1], data[-1])
+    assert np.allclose(runs[:,-1,2,-2], data[:,-1,2,-2])
+    
+    mask = data[...,0] > np.median(data[...,0])
+    assert np.allclose(runs[mask], data[mask])
+    assert np.allclose(runs[mask,1:4], data[mask,1:4])
+    
+    # Arrays over space and time index pointwise
+    assert np.allclose(runs[[0,1],[2,3],[4,5],[0,4]], 
+            data[[0,1],[2,3],[4,5],[0,4]])
+    mask4d = data > np.median(data)
+    assert np.allclose(runs[mask4d], data[mask4d])
+    
+    # and a compressed run is read through its proxy
+    import os
+    import shutil
+    import tempfile
+    tmpdir = tempfile.mkdtemp()
+    try:
+        filename = os.path.join(tmpdir, 'bold.nii.gz')
+        nb.save(bold, filename)
+        gz_runs = pre.Runs([filename, bold])
+        assert np.allclose(gz_runs[...], data)
+        assert np.allclose(gz_runs[1:3,2:5,...,[5,0,3]], 
+                data[1:3,2:5,...,[5,0,3]])
+        assert np.allclose(gz_runs[-1,2], data[-1,2])
+        assert np.allclose(gz_runs[mask], data[mask])
+    finally:
+        shutil.rmtree(tmpdir)
+    
+    # and it works in place of a nifti
+    assert pre.num_active_voxels(runs) == pre.num_active_voxels(combined)
+    assert np.allclose(
+            pre.extract(runs, roi).data, pre.extract(combined, roi).data)
+
+
+def test_label_index():
+    from modelmodel.roi import atlas
+
+    labels = np.array([[0, 2, 1], [2, 0, 5], [1, 1, 2]])
+    indices = atlas._label_index(labels, [1, 2, 5, 7])
+    
+    # Same as searching for each label
+    for code, index in zip([1, 2, 5, 7], indices):
+        assert np.array_equal(index, np.flatnonzero(labels == code)), (
+                "Label {0} is off".format(code))
+
+
+def _atlas_zip(tmpdir):
+    """Make a small atlases zip, with a label nifti and its legend, and 
+    have atlas read from it (undo with atlas._ZIPS.clear())."""
+    import os
+    import gzip
+    from io import BytesIO
+    from zipfile import ZipFile
+    from modelmodel.roi import atlas
+
+    labels = np.zeros((6, 5, 4), dtype=np.uint8)
+    labels[0:2,1:3,0] = 1
+    labels[3:5,:,2:4] = 2
+    labels[5,4,3] = 4
+    nifti = nb.Nifti1Image(labels, np.diag([2., 2., 2., 1.]))
+    
+    fileobj = BytesIO()
+    nifti.to_file_map({'header' : nb.FileHolder(fileobj=fileobj), 
+            'image' : nb.FileHolder(fileobj=fileobj)})
+    
+    compressed = BytesIO()
+    gzipped = gzip.GzipFile(fileobj=compressed, mode='wb')
+    gzipped.write(fileobj.getvalue())
+    gzipped.close()
+    
+    filename = os.path.join(tmpdir, 'atlases.zip')
+    zipped = ZipFile(filename, 'w')
+    zipped.writestr('atlases/test_atlas_zip/base.nii.gz', 
+            compressed.getvalue())
+    zipped.writestr('atlases/test_atlas_zip_legend.txt', 
+            '1:One\n2:Two\n4:Four\n')
+    zipped.close()
+    
+    atlas._ZIPS.clear()
+    atlas._ZIPS[os.getpid()] = ZipFile(filename)
+
+    return labels
+
+
+def test_atlas_zip():
+    import shutil
+    import tempfile
+    from modelmodel.roi import atlas
+
+    tmpdir = tempfile.mkdtemp()
+    try:
+        labels = _atlas_zip(tmpdir)
+        
+        nifti = atlas._read_atlas_nifti('test_atlas_zip', 'base.nii.gz')
+        assert np.array_equal(nifti.get_data(), labels), "Nifti malfunction"
+        assert np.allclose(nifti.get_affine(), np.diag([2., 2., 2., 1.]))
+        
+        fhandle = atlas._atlas_file('test_atlas_zip_legend.txt')
+        assert fhandle.read() == b'1:One\n2:Two\n4:Four\n', (
+                "File malfunction")
+        assert atlas._read_legend('test_atlas_zip_legend.txt') == {
+                'One' : 1, 'Two' : 2, 'Four' : 4}, "Legend malfunction"
+        
+        try:
+            atlas._atlas_file('test_atlas_zip', 'missing.nii')
+        except IOError:
+            pass
+        else:
+            raise AssertionError("Missing file not raised")
+    finally:
+        for handle in atlas._ZIPS.values():
+            handle.close()
+        atlas._ZIPS.clear()
+        shutil.rmtree(tmpdir)
+
+
+def test_atlas_index():
+    import os
+    import shutil
+    import tempfile
+    from modelmodel.roi import atlas
+
+    atlases = os.path.join(atlas.roi.__path__[0], 'atlases')
+    made = not os.path.exists(atlases)
+    tmpdir = tempfile.mkdtemp()
+    try:
+        labels = _atlas_zip(tmpdir)
+        atlas.create_index(
+                'test_atlas_zip', 'base.nii.gz', 'test_atlas_zip_legend.txt')
+        
+        # Each roi has the voxels of its label
+        for name, code in [('One', 1), ('Two', 2), ('Four', 4)]:
+            roidata = atlas.get_roi('test_atlas_zip', name + '.nii')
+            assert isinstance(roidata, pre.RoiData), "Not RoiData"
+            assert np.array_equal(
+                    roidata.index, np.flatnonzero(labels == code)), (
+                    "{0} is off".format(name))
+            assert roidata.shape == labels.shape, "Wrong shape"
+            
+            # Cached on the second call
+            assert atlas.get_roi('test_atlas_zip', name + '.nii') is roidata
+            
+            # and as a nifti1 mask
+            nifti = roidata.to_nifti()
+            assert nifti.get_data().dtype == np.uint8, "Mask dtype off"
+            assert np.array_equal(nifti.get_data(), labels == code), (
+                    "{0} mask is off".format(name))
+        
+        assert 'test_atlas_zip' in atlas._INDEXES, "Index not cached"
+    finally:
+        for handle in atlas._ZIPS.values():
+            handle.close()
+        atlas._ZIPS.clear()
+        atlas._INDEXES.clear()
+        atlas._ROIS.clear()
+        shutil.rmtree(tmpdir)
+        if made:
+            shutil.rmtree(atlases)
+        else:
+            shutil.rmtree(os.path.join(atlases, 'test_atlas_zip'))
+
+
+def test_roi_index_cache():
+    bold, roi = _bold_roi()
+    pre.roi_index_cache.clear()
+
+    first = pre.extract(bold, roi)
+    assert len(pre.roi_index_cache._memory) == 1, "Index not cached"
+    
+    # Cached index is used, and is the same 
+    second = pre.extract(bold, roi)
+    assert np.array_equal(first.index, second.index)
+    assert len(pre.roi_index_cache._memory) == 1, "Index cached twice"
+
+
+def test_mask_many_parallel():
+    bold, roi = _bold_roi()
+    rois = [roi, pre.RoiData(np.arange(40, 400, 7), bold.get_affine(), 
+            bold.shape)]
+    
+    serial = pre.mask_many(bold, rois)
+    parallel = pre.mask_many(bold, rois, n_jobs=2)
+    for rs, rp in zip(serial, parallel):
+        assert np.array_equal(rs.index, rp.index), "Index differs"
+        assert np.allclose(rs.data, rp.data), "Data differs"
+
+
+def test_summarize():
+    prng = np.random.RandomState(42)
+    affine = np.eye(4)
+    roi1 = pre.RoiData(
+            np.arange(10), affine, (10, 10, 10), prng.normal(size=(10, 5)))
+    roi2 = pre.RoiData(
+            np.arange(20, 27), affine, (10, 10, 10), prng.normal(size=(7, 5)))
+    
+    summary = pre.summarize([roi1, roi2], threshold=0.0, k=3)
+    for i, roidata in enumerate([roi1, roi2]):
+        data = roidata.data
+        assert np.allclose(summary['mean'][i], data.mean(axis=0))
+        assert np.allclose(summary['median'][i], np.median(data, axis=0))
+        assert np.allclose(summary['var'][i], data.var(axis=0))
+        assert np.allclose(summary['n_active'][i], np.sum(data > 0, axis=0))
+        
+        top = roidata.index[np.argsort(data.var(axis=1))[::-1][0:3]]
+        assert np.array_equal(summary['top_var'][i], top), "top_var off"
+    
+    assert np.array_equal(pre.top_var(roi1, 30), summary['top_var'][0])
+
+    # A nan stays in its own roi
+    roi1.data[0,0] = np.nan
+    empty = pre.RoiData(
+            np.arange(0), affine, (10, 10, 10), np.zeros((0, 5)))
+    summary = pre.summarize([roi1, empty, roi2])
+    for key in ['mean', 'median', 'var']:
+        assert np.isnan(summary[key][0,0]), "nan lost"
+        assert np.all(np.isfinite(summary[key][0,1:])), "nan leaked"
+        assert np.all(np.isnan(summary[key][1])), "empty malfunction"
+    assert np.allclose(summary['mean'][2], roi2.data.mean(axis=0))
+    assert np.allclose(summary['median'][2], np.median(roi2.data, axis=0))
+    assert np.allclose(summary['var'][2], roi2.data.var(axis=0))
+
+
+def test_top():
+    prng = np.random.RandomState(42)
+    shape = (10, 10, 10)
+    roi1 = pre.RoiData(
+            np.arange(0, 100, 5), np.eye(4), shape, prng.normal(size=(20, 8)))
+    roi2 = pre.RoiData(
+            np.arange(300, 310), np.eye(4), shape, prng.normal(size=(10, 8)))
+    tmap = prng.normal(size=shape)
+    
+    # top_t
+    top = pre.top_t(roi1, tmap, 10)
+    tvals = tmap.ravel()[roi1.index]
+    assert np.array_equal(top, roi1.index[np.argsort(tvals)[::-1][0:2]])
+    
+    # top_var
+    top = pre.top_var(roi1, 25)
+    order = np.argsort(roi1.data.var(axis=1))[::-1]
+    assert np.array_equal(top, roi1.index[order[0:5]]), "top_var off"
+
+    # top_info
+    top = pre.top_info(roi1, 50)
+    assert len(top) == 10, "top_info off"
+    assert set(top).issubset(roi1.index), "top_info off grid"
+    
+    # Batched
+    tops = pre.top_var([roi1, roi2], [10, 50])
+    assert len(tops) == 2 and len(tops[0]) == 2, "Wrong batch layout"
+    assert np.array_equal(tops[0][1], pre.top_var(roi1, 50))
+    assert np.array_equal(tops[1][0], pre.top_var(roi2, 10))
+
+
+def test_pca_ica():
+    prng = np.random.RandomState(42)
+    
+    # Two sources mixed into 200 voxels
+    n_vol = 100
+    t = np.arange(n_vol)
+    sources = np.vstack([np.sin(t / 3.0), np.sign(np.cos(t / 7.0))])
+    data = prng.normal(size=(200, 2)).dot(sources) + (
+            prng.normal(scale=0.01, size=(200, n_vol)))
+    roidata = pre.RoiData(np.arange(200), np.eye(4), (10, 10, 10), data)
+    
+    # The pca timecourses should match an
+    # exact SVD of the centered data
+    timecourses, prng = pre.pca(roidata, 2, chunk=7, prng=prng)
+    centered = data - data.mean(axis=1)[:,np.newaxis]
+    vt = np.linalg.svd(centered, full_matrices=False)[2]
+    for j in range(2):
+        assert np.allclose(np.abs(timecourses[:,j]), np.abs(vt[j]), 
+                atol=1e-3), "pca component {0} is off".format(j)
+    
+    # Each ica timecourse should recover a source
+    ics, prng = pre.ica(roidata, 2, chunk=7, prng=prng)
+    corr = np.abs(np.corrcoef(ics.T, sources)[0:2,2:4])
+    assert np.all(corr.max(axis=1) > 0.95), "sources not recovered"
+    
+    # Streaming from a nifti gives the same pca
+    bold = roidata.to_nifti()
+    bold_timecourses, prng = pre.pca(bold, 2, roi=roidata, prng=prng)
+    assert np.allclose(np.abs(bold_timecourses), np.abs(timecourses), 
+            atol=1e-3), "nifti pca differs"
+    
+    # and from a compressed file, in chunks
+    import os
+    import shutil
+    import tempfile
+    tmpdir = tempfile.mkdtemp()
+    try:
+        filename = os.path.join(tmpdir, 'bold.nii.gz')
+        nb.save(bold, filename)
+        gz_timecourses, prng = pre.pca(
+                nb.load(filename), 2, roi=roidata, chunk=7, prng=prng)
+        assert np.allclose(np.abs(gz_timecourses), np.abs(timecourses), 
+                atol=1e-3), ".nii.gz pca differs"
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def test_dtime():
+    from modelmodel.roi import timing
+
+    trials = [1, 2, 3]
+    durations = [2, 3, 1]
+    assert np.array_equal(
+            timing.dtime(trials, durations), [1, 1, 2, 2, 2, 3])
+    assert np.array_equal(
+            timing.dtime(trials, durations, drop=[0, 1, 0]), 
+            [1, 0, 2, 0, 2, 3])
+    assert np.array_equal(
+            timing.dtime(['a', 'b'], [3, 2], drop=[1, 0, 1], drop_value='0'),
+            ['0', 'a', '0', '0', 'b'])
+    
+    # 2d, by rows
+    rows = np.array([[1, 2], [3, 4]])
+    assert np.array_equal(
+            timing.dtime(rows, [2, 1], drop=[0, 1]), 
+            [[1, 2], [0, 0], [3, 4]])
+
+
+def test_add_empty():
+    from modelmodel.roi import timing
+
+    conditions = [1, 0, 2, 0, 0, 1]
+    assert timing.add_empty([5, 6, 7], conditions) == [5, 0, 6, 0, 0, 7]
+    assert timing.add_empty(['a', 'b', 'c'], conditions) == (
+            ['a', '0', 'b', '0', '0', 'c'])
+    
+    # 2d, by rows
+    rows = np.array([[1, 2], [3, 4], [5, 6]])
+    assert np.array_equal(timing.add_empty(rows, conditions), 
+            [[1, 2], [0, 0], [3, 4], [0, 0], [0, 0], [5, 6]])
+
+
+def test_events():
+    from modelmodel.roi import timing
+
+    # Two conditions, TR = 2
+    stim, names = timing.events(
+            onsets=[0, 4, 5], durations=[2, 4, 0], amplitudes=[1, 2, 3],
+            conditions=['a', 'a', 'b'], TR=2, n_tr=5, oversample=4)
+    
+    assert list(names) == ['a', 'b'], "conditions are off"
+    assert stim.shape == (5, 2), "shape is off"
+    assert np.allclose(stim[:,0], [1, 0, 2, 2, 0]), "a is off"
+    
+    # The impulse at 5s fills one of the 4 bins of the third TR
+    assert np.allclose(stim[:,1], [0, 0, 0.75, 0, 0]), "b is off"